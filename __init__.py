@@ -28,7 +28,7 @@ from .nostr.nostr_client import NostrClient
 
 nostr_client = NostrClient()
 
-from .tasks import wait_for_nostr_events
+from .tasks import flush_sync_cursors_forever, wait_for_nostr_events
 from .views import *
 from .views_api import *
 
@@ -43,13 +43,11 @@ def poap_stop():
 
 def poap_start():
     async def _subscribe_to_nostr_client():
-        # wait for 'nostrclient' extension to initialize
-        await asyncio.sleep(10)
+        # retries with backoff until the 'nostrclient' extension is ready
         await nostr_client.run_forever()
 
     async def _wait_for_nostr_events():
-        # wait for this extension to initialize
-        await asyncio.sleep(15)
+        # waits for the 'nostrclient' websocket to open
         await wait_for_nostr_events(nostr_client)
 
     # task1 may be needed in the future
@@ -60,4 +58,7 @@ def poap_start():
     task3 = create_permanent_unique_task(
         "ext_poap_wait_for_events", _wait_for_nostr_events
     )
-    scheduled_tasks.extend([task2, task3])
+    task4 = create_permanent_unique_task(
+        "ext_poap_flush_sync_cursors", flush_sync_cursors_forever
+    )
+    scheduled_tasks.extend([task2, task3, task4])
@@ -0,0 +1,18 @@
+import importlib
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def load_module(name: str):
+    """
+    Import a module of the extension without running its `__init__`, which
+    needs a running LNbits. The module dependencies must be installed.
+    """
+    if "poap" not in sys.modules:
+        package = types.ModuleType("poap")
+        package.__path__ = [str(ROOT)]
+        sys.modules["poap"] = package
+    return importlib.import_module(f"poap.{name}")
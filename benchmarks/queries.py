@@ -0,0 +1,169 @@
+"""
+Timings of the hot awards and issuers queries on a large SQLite table,
+before and after the indexes of migration m003.
+
+    python benchmarks/queries.py [--rows 2000000] [--runs 20]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+# mirrors m001 and m003
+TABLES = [
+    """
+    CREATE TABLE issuers (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        private_key TEXT NOT NULL,
+        public_key TEXT NOT NULL,
+        meta TEXT NOT NULL DEFAULT '{}'
+    )
+    """,
+    """
+    CREATE TABLE awards (
+        id TEXT PRIMARY KEY,
+        badge_id TEXT NOT NULL,
+        issuer TEXT NOT NULL,
+        claim_pubkey TEXT NOT NULL,
+        event_id TEXT,
+        event_created_at INT
+    )
+    """,
+]
+INDEXES = [
+    "CREATE INDEX issuers_public_key ON issuers (public_key)",
+    "CREATE INDEX issuers_user_id ON issuers (user_id)",
+    "CREATE INDEX awards_issuer ON awards (issuer, event_created_at, id)",
+    "CREATE INDEX awards_badge ON awards (badge_id, event_created_at, id)",
+    "CREATE UNIQUE INDEX awards_badge_claim ON awards (badge_id, claim_pubkey)",
+]
+
+PAGE = """
+    SELECT * FROM awards WHERE {column} = ?
+    AND (event_created_at < ? OR (event_created_at = ? AND id < ?))
+    ORDER BY event_created_at DESC, id DESC
+    LIMIT 100
+"""
+
+
+def hex_id(bits=256) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+def populate(conn: sqlite3.Connection, rows: int, issuers: int, badges: int):
+    issuer_rows = [
+        (hex_id(128), hex_id(128), hex_id(), hex_id()) for _ in range(issuers)
+    ]
+    conn.executemany(
+        "INSERT INTO issuers (id, user_id, private_key, public_key) VALUES (?, ?, ?, ?)",
+        issuer_rows,
+    )
+    badge_issuers = [
+        (hex_id(128), random.choice(issuer_rows)[0]) for _ in range(badges)
+    ]
+    now = int(time.time())
+
+    def awards():
+        for _ in range(rows):
+            badge_id, issuer = random.choice(badge_issuers)
+            yield (
+                hex_id(128),
+                badge_id,
+                issuer,
+                hex_id(),
+                hex_id(),
+                now - random.randrange(3 * 365 * 24 * 3600),
+            )
+
+    conn.executemany("INSERT INTO awards VALUES (?, ?, ?, ?, ?, ?)", awards())
+    conn.commit()
+    return issuer_rows, badge_issuers
+
+
+def sample_queries(conn: sqlite3.Connection, rows: int, issuer_rows, badge_issuers):
+    """
+    Every call returns the query and the values of one run, picked from the
+    stored rows so that every lookup finds something.
+    """
+    now = int(time.time())
+
+    def claim_check():
+        award = conn.execute(
+            "SELECT badge_id, claim_pubkey FROM awards WHERE rowid = ?",
+            (random.randrange(1, rows + 1),),
+        ).fetchone()
+        return "SELECT id FROM awards WHERE badge_id = ? AND claim_pubkey = ?", award
+
+    return {
+        "issuer by public key": lambda: (
+            "SELECT * FROM issuers WHERE public_key = ?",
+            (random.choice(issuer_rows)[3],),
+        ),
+        "award by badge and claimer": claim_check,
+        "awards page by badge": lambda: (
+            PAGE.format(column="badge_id"),
+            (random.choice(badge_issuers)[0], now, now, ""),
+        ),
+        "awards page by issuer": lambda: (
+            PAGE.format(column="issuer"),
+            (random.choice(issuer_rows)[0], now, now, ""),
+        ),
+    }
+
+
+def time_queries(conn: sqlite3.Connection, queries, runs: int) -> dict:
+    timings = {}
+    for name, sample in queries.items():
+        samples = []
+        for _ in range(runs):
+            query, values = sample()
+            start = time.perf_counter()
+            conn.execute(query, values).fetchall()
+            samples.append((time.perf_counter() - start) * 1000)
+        timings[name] = statistics.median(samples)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--issuers", type=int, default=1_000)
+    parser.add_argument("--badges", type=int, default=20_000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "poap.db"))
+        for table in TABLES:
+            conn.execute(table)
+
+        start = time.perf_counter()
+        issuer_rows, badge_issuers = populate(
+            conn, args.rows, args.issuers, args.badges
+        )
+        print(f"{args.rows} awards inserted in {time.perf_counter() - start:.1f}s")
+        queries = sample_queries(conn, args.rows, issuer_rows, badge_issuers)
+
+        before = time_queries(conn, queries, args.runs)
+        start = time.perf_counter()
+        for index in INDEXES:
+            conn.execute(index)
+        conn.execute("ANALYZE")
+        print(f"m003 indexes built in {time.perf_counter() - start:.1f}s\n")
+        after = time_queries(conn, queries, args.runs)
+        conn.close()
+
+    print(f"{'median ms':<28} {'before':>10} {'after':>10}")
+    for name in queries:
+        print(
+            f"{name:<28} {before[name]:>10.2f} {after[name]:>10.3f}"
+            f"  x{before[name] / after[name]:.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Checks that `serialize_event` is byte for byte the `json.dumps` call it
+replaced, on random events with unicode and escaped content, and times both.
+Exits with an error on the first mismatch.
+
+    python benchmarks/serialize.py [--count 20000] [--seed 1]
+"""
+import argparse
+import hashlib
+import json
+import random
+import sys
+import time
+
+from _extension import load_module
+
+event = load_module("nostr.event")
+
+ALPHABETS = [
+    "abcdefghijklmnopqrstuvwxyz0123456789 ",
+    '"\\/\b\f\n\r\t',
+    "".join(chr(c) for c in range(0x20)) + "\x7f",
+    "éàüñçßøåæœ€£¥",
+    "日本語のテキスト中文한국어",
+    "😀🎉🏅⚡️👍🏽\u200d\ufeff",
+    "\u2028\u2029\ud7ff\ue000\uffff",
+]
+
+
+def random_text(max_length: int) -> str:
+    alphabet = "".join(random.sample(ALPHABETS, random.randint(1, len(ALPHABETS))))
+    return "".join(random.choices(alphabet, k=random.randint(0, max_length)))
+
+
+def random_event() -> list:
+    tags = [
+        [random_text(8) for _ in range(random.randint(1, 4))]
+        for _ in range(random.randint(0, 8))
+    ]
+    return [
+        f"{random.getrandbits(256):064x}",
+        random.randint(0, 2**40),
+        random.choice([0, 1, 4, 8, 30008, 30009, random.randint(0, 65535)]),
+        tags,
+        random_text(500),
+    ]
+
+
+def json_dumps(pubkey, created_at, kind, tags, content) -> str:
+    return json.dumps(
+        [0, pubkey, created_at, kind, tags, content],
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+
+
+def elapsed_ms(serialize, events) -> float:
+    start = time.perf_counter()
+    for e in events:
+        serialize(*e)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    events = [random_event() for _ in range(args.count)]
+
+    for i, e in enumerate(events):
+        expected = json_dumps(*e).encode()
+        serialized = event.serialize_event(*e).encode()
+        ingest_event = event.IngestEvent("", *e)
+        if (
+            serialized != expected
+            or ingest_event.event_id != hashlib.sha256(expected).hexdigest()
+        ):
+            print(f"mismatch on event {i}: {e!r}")
+            sys.exit(1)
+    print(f"{args.count} events serialized byte for byte as json.dumps")
+
+    before = elapsed_ms(json_dumps, events)
+    after = elapsed_ms(event.serialize_event, events)
+    print(f"{'json.dumps':<20} {before:>10.1f} ms")
+    print(f"{'serialize_event':<20} {after:>10.1f} ms  x{before / after:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Signatures per second when the private key is parsed for every signature
+(the previous behaviour) against the cached signer and the batch API.
+
+    python benchmarks/signing.py [--count 5000]
+"""
+import argparse
+import hashlib
+import os
+import time
+
+import secp256k1
+
+from _extension import load_module
+
+helpers = load_module("helpers")
+
+
+def signatures_per_second(sign, count: int) -> float:
+    start = time.perf_counter()
+    sign()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=5_000)
+    args = parser.parse_args()
+
+    private_key = os.urandom(32).hex()
+    hashes = [hashlib.sha256(os.urandom(32)).digest() for _ in range(args.count)]
+
+    def parse_every_time():
+        for h in hashes:
+            signer = secp256k1.PrivateKey(bytes.fromhex(private_key))
+            signer.schnorr_sign(h, None, raw=True).hex()
+
+    def cached_signer():
+        for h in hashes:
+            helpers.sign_message_hash(private_key, h)
+
+    def batch():
+        helpers.sign_message_hashes(private_key, hashes)
+
+    # the first call also parses the key, keep it out of the measure
+    helpers.sign_message_hash(private_key, hashes[0])
+
+    baseline = signatures_per_second(parse_every_time, args.count)
+    print(f"{'key parsed per signature':<28} {baseline:>10.0f} sig/s")
+    for name, sign in [("cached signer", cached_signer), ("batch", batch)]:
+        rate = signatures_per_second(sign, args.count)
+        print(f"{name:<28} {rate:>10.0f} sig/s  x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
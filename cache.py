@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, List, Optional
+
+
+class LRUCache:
+    """
+    In-memory LRU cache with an optional time-to-live for the entries.
+    Keeps hit and miss counters so its efficiency can be monitored.
+    Safe to share with executor threads.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        assert max_size > 0, "Cache size must be positive"
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._entries.keys())
+
+    def add_if_absent(self, key: Hashable) -> bool:
+        """
+        Use the cache as a bounded set.
+        Returns `False` (a hit) if the key was already present.
+        """
+        if self.get(key) is not None:
+            return False
+        self.put(key, True)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _expired(self, entry) -> bool:
+        expires_at = entry[1]
+        return expires_at is not None and expires_at < time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,11 +1,108 @@
-from typing import List, Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from lnbits.db import SQLITE, Connection
 from lnbits.helpers import urlsafe_short_hash
+import sqlite3
 import uuid
 
 from . import db
-from .models import CreateIssuer, Issuer, POAP, CreatePOAP, CreateAward, Award
+from .models import (
+    CreateIssuer,
+    Issuer,
+    POAP,
+    CreatePOAP,
+    CreateAward,
+    Award,
+    AwardCounter,
+)
 from loguru import logger
 
+# RETURNING needs SQLite 3.35, Postgres and CockroachDB always have it
+RETURNING_SUPPORTED = db.type != SQLITE or sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+async def _write_returning(query: str, values: tuple, table: str, row_id: str):
+    """
+    Run the write and return the written row from the same statement.
+    Falls back to a separate read by id where RETURNING is not supported.
+    """
+    if RETURNING_SUPPORTED:
+        return await db.fetchone(f"{query.rstrip()} RETURNING *", values)
+    await db.execute(query, values)
+    return await db.fetchone(f"SELECT * FROM {table} WHERE id = ?", (row_id,))
+
+
+# stay under the bind parameter limit of older SQLite builds
+MAX_BIND_PARAMS = 999
+
+
+async def _bulk_insert(
+    conn: Connection,
+    table: str,
+    columns: List[str],
+    rows: List[tuple],
+    returning=False,
+) -> List[dict]:
+    """
+    Insert the rows with multi-row `INSERT ... ON CONFLICT DO NOTHING`
+    statements on the given connection.
+    With `returning` the rows actually inserted are returned.
+    """
+    placeholders = f"({', '.join('?' for _ in columns)})"
+    chunk_size = MAX_BIND_PARAMS // len(columns)
+    inserted: List[dict] = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start : start + chunk_size]
+        query = f"""
+            INSERT INTO {table} ({', '.join(columns)})
+            VALUES {', '.join(placeholders for _ in chunk)}
+            ON CONFLICT DO NOTHING
+            """
+        values = tuple(value for row in chunk for value in row)
+        if returning:
+            inserted += await conn.fetchall(f"{query.rstrip()} RETURNING *", values)
+        else:
+            await conn.execute(query, values)
+    return inserted
+
+
+async def _get_page(
+    table: str,
+    column: str,
+    value: str,
+    limit: int,
+    after: Optional[Tuple[int, str]] = None,
+) -> List[dict]:
+    """
+    Rows where `column` is `value`, newest first, keyset paginated on
+    `(event_created_at, id)`. `after` is the key of the last row already read.
+    """
+    where, values = f"{column} = ?", [value]
+    if after:
+        where += " AND (event_created_at < ? OR (event_created_at = ? AND id < ?))"
+        values += [after[0], after[0], after[1]]
+    return await db.fetchall(
+        f"""
+        SELECT * FROM {table} WHERE {where}
+        ORDER BY event_created_at DESC, id DESC
+        LIMIT ?
+        """,
+        (*values, limit),
+    )
+
+
+async def _stream_rows(
+    table: str, column: str, value: str, page_size: int
+) -> AsyncIterator[dict]:
+    after = None
+    while True:
+        rows = await _get_page(table, column, value, page_size, after)
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        after = (rows[-1]["event_created_at"], rows[-1]["id"])
+
+
 ######################################## ISSUER ########################################
 
 
@@ -31,16 +128,17 @@ async def get_issuers_ids_with_pubkeys() -> List[str]:
 
 async def create_issuer(user_id: str, data: CreateIssuer) -> Issuer:
     issuer_id = urlsafe_short_hash()
-    await db.execute(
+    row = await _write_returning(
         """
         INSERT INTO poap.issuers (id, user_id, private_key, public_key, meta)
         VALUES (?, ?, ?, ?, ?)
         """,
         (issuer_id, user_id, data.private_key, data.public_key, data.meta),
+        "poap.issuers",
+        issuer_id,
     )
-    issuer = await get_issuer(issuer_id)
-    assert issuer, "Newly created issuer couldn't be retrieved"
-    return issuer
+    assert row, "Newly created issuer couldn't be retrieved"
+    return Issuer(**row)
 
 
 async def get_issuer(issuer_id: str) -> Optional[Issuer]:
@@ -58,12 +156,14 @@ async def delete_issuer_poaps(issuer_id: str) -> None:
 
 
 async def delete_issuer_awards(issuer_id: str) -> None:
-    await db.execute(
-        """
-        DELETE FROM poap.awards WHERE issuer = ?
-        """,
-        (issuer_id,),
-    )
+    async with db.connect() as conn:
+        await _delete_award_counters(conn, issuer_id)
+        await conn.execute(
+            """
+            DELETE FROM poap.awards WHERE issuer = ?
+            """,
+            (issuer_id,),
+        )
 
 
 async def delete_issuer(issuer_id: str) -> None:
@@ -81,7 +181,7 @@ async def delete_issuer(issuer_id: str) -> None:
 async def create_poap(issuer_id: str, data: CreatePOAP) -> POAP:
     logger.debug(f"Creating poap for issuer {issuer_id}, data: {data}")
     badge_id = data.id or uuid.uuid4().hex
-    await db.execute(
+    row = await _write_returning(
         """
         INSERT INTO poap.badges (id, issuer_id, name, description, image, thumbs, event_id, event_created_at, geohash)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -95,15 +195,50 @@ async def create_poap(issuer_id: str, data: CreatePOAP) -> POAP:
             data.image,
             data.thumbs,
             data.event_id,
-            data.event_created_at,
+            data.event_created_at or 0,
             data.geohash,
         ),
+        "poap.badges",
+        badge_id,
     )
-    poap = await get_poap(badge_id)
+    # nothing is returned if the badge already existed
+    poap = POAP(**row) if row else await get_poap(badge_id)
     assert poap, "Newly created poap couldn't be retrieved"
     return poap
 
 
+async def bulk_create_poaps(poaps: List[POAP], conn: Connection) -> None:
+    await _bulk_insert(
+        conn,
+        "poap.badges",
+        [
+            "id",
+            "issuer_id",
+            "name",
+            "description",
+            "image",
+            "thumbs",
+            "event_id",
+            "event_created_at",
+            "geohash",
+        ],
+        [
+            (
+                p.id,
+                p.issuer_id,
+                p.name,
+                p.description,
+                p.image,
+                p.thumbs,
+                p.event_id,
+                p.event_created_at,
+                p.geohash,
+            )
+            for p in poaps
+        ],
+    )
+
+
 async def get_poap(badge_id: str) -> Optional[POAP]:
     row = await db.fetchone("SELECT * FROM poap.badges WHERE id = ?", (badge_id,))
     return POAP(**row) if row else None
@@ -116,8 +251,15 @@ async def get_poaps(issuer_id: str) -> List[POAP]:
     return [POAP(**row) for row in rows]
 
 
+async def get_poaps_page(
+    issuer_id: str, limit: int, after: Optional[Tuple[int, str]] = None
+) -> List[POAP]:
+    rows = await _get_page("poap.badges", "issuer_id", issuer_id, limit, after)
+    return [POAP(**row) for row in rows]
+
+
 async def update_poap(issuer_id: str, data: POAP) -> Optional[POAP]:
-    await db.execute(
+    row = await _write_returning(
         """
         UPDATE poap.badges SET name = ?, description = ?, image = ?, thumbs = ?, event_id = ?, event_created_at = ?, geohash = ?
         WHERE issuer_id = ? AND id = ?
@@ -133,8 +275,10 @@ async def update_poap(issuer_id: str, data: POAP) -> Optional[POAP]:
             issuer_id,
             data.id,
         ),
+        "poap.badges",
+        data.id,
     )
-    return await get_poap(data.id)
+    return POAP(**row) if row else None
 
 
 async def delete_poap(issuer_id: str, badge_id: str) -> None:
@@ -146,53 +290,111 @@ async def delete_poap(issuer_id: str, badge_id: str) -> None:
     )
 
 
-async def get_last_poap_update_time() -> int:
-    row = await db.fetchone(
-        """
-            SELECT event_created_at FROM poap.badges 
-            ORDER BY event_created_at DESC LIMIT 1
-        """,
-        (),
-    )
-    return row[0] or 0 if row else 0
-
-
 ######################################## AWARD ########################################
 
 
-async def create_award_poap(issuer_id: str, data: CreateAward) -> Award:
-    award_id = data.id or uuid.uuid4().hex
-    await db.execute(
-        """
+async def _insert_award(conn: Connection, data: CreateAward) -> Optional[dict]:
+    """
+    Insert the award and count it, on the caller's transaction.
+    Returns `None` if the award, or one of the same badge to the same
+    public key, already existed.
+    """
+    query = """
         INSERT INTO poap.awards (id, badge_id, issuer, claim_pubkey, event_id, event_created_at)
         VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(id) DO NOTHING
-        """,
-        (
-            award_id,
-            data.badge_id,
-            issuer_id,
-            data.claim_pubkey,
-            data.event_id,
-            data.event_created_at,
-        ),
+        ON CONFLICT DO NOTHING
+        """
+    values = (
+        data.id,
+        data.badge_id,
+        data.issuer,
+        data.claim_pubkey,
+        data.event_id,
+        data.event_created_at,
     )
-    award = await get_award_poap(award_id)
-    assert award, "Newly created award couldn't be retrieved"
-    return award
+    if RETURNING_SUPPORTED:
+        row = await conn.fetchone(f"{query.rstrip()} RETURNING *", values)
+    else:
+        existing = await conn.fetchone(
+            """
+            SELECT 1 FROM poap.awards
+            WHERE id = ? OR (badge_id = ? AND claim_pubkey = ?)
+            """,
+            (data.id, data.badge_id, data.claim_pubkey),
+        )
+        if existing:
+            return None
+        await conn.execute(query, values)
+        row = await conn.fetchone("SELECT * FROM poap.awards WHERE id = ?", (data.id,))
+
+    if row:
+        await _count_awards(conn, [row])
+    return row
+
+
+async def bulk_create_awards(awards: List[CreateAward], conn: Connection) -> None:
+    if not RETURNING_SUPPORTED:
+        # the inserted rows must be known to count them
+        for award in awards:
+            await _insert_award(conn, award)
+        return
+
+    rows = await _bulk_insert(
+        conn,
+        "poap.awards",
+        ["id", "badge_id", "issuer", "claim_pubkey", "event_id", "event_created_at"],
+        [
+            (
+                a.id,
+                a.badge_id,
+                a.issuer,
+                a.claim_pubkey,
+                a.event_id,
+                a.event_created_at,
+            )
+            for a in awards
+        ],
+        returning=True,
+    )
+    await _count_awards(conn, rows)
 
 
-async def check_awarded_to_pubkey(badge_id: str, pubkey: str):
-    # check if the badge as been awarded to pubkey
-    count = await db.fetchone(
-        "SELECT COUNT(1) FROM poap.awards WHERE badge_id = ? AND claim_pubkey = ?",
-        (
-            badge_id,
-            pubkey,
-        ),
-    )
-    exists = int(count[0])
-    return not exists
+async def claim_award(data: Award) -> Optional[Award]:
+    """
+    Insert and count the award unless the badge was already awarded to the
+    public key, in one transaction. Returns `None` if it was already awarded.
+    """
+    async with db.connect() as conn:
+        row = await _insert_award(conn, data)
+    return Award(**row) if row else None
+
+
+async def unclaim_award(award: Award) -> None:
+    """
+    Delete an award that could not be published and take it off the counters.
+    """
+    async with db.connect() as conn:
+        await conn.execute("DELETE FROM poap.awards WHERE id = ?", (award.id,))
+        for scope, column, scope_id in [
+            ("badge", "badge_id", award.badge_id),
+            ("issuer", "issuer", award.issuer),
+        ]:
+            await conn.execute(
+                f"""
+                UPDATE poap.award_counters SET
+                    awards = awards - 1,
+                    first_award_at = (
+                        SELECT MIN(NULLIF(event_created_at, 0))
+                        FROM poap.awards WHERE {column} = ?
+                    ),
+                    last_award_at = (
+                        SELECT MAX(NULLIF(event_created_at, 0))
+                        FROM poap.awards WHERE {column} = ?
+                    )
+                WHERE scope = ? AND scope_id = ?
+                """,
+                (scope_id, scope_id, scope, scope_id),
+            )
 
 
 async def get_award_poap(award_id: str) -> Optional[Award]:
@@ -200,42 +402,158 @@ async def get_award_poap(award_id: str) -> Optional[Award]:
     return Award(**row) if row else None
 
 
-async def get_awards_poap(badge_id: str) -> List[Award]:
-    rows = await db.fetchall(
-        "SELECT * FROM poap.awards WHERE badge_id = ?", (badge_id,)
-    )
+async def get_awards_poap_page(
+    badge_id: str, limit: int, after: Optional[Tuple[int, str]] = None
+) -> List[Award]:
+    rows = await _get_page("poap.awards", "badge_id", badge_id, limit, after)
     return [Award(**row) for row in rows]
 
 
-async def get_awards(issuer: str) -> List[Award]:
-    rows = await db.fetchall("SELECT * FROM poap.awards WHERE issuer = ?", (issuer,))
+async def get_awards_page(
+    issuer: str, limit: int, after: Optional[Tuple[int, str]] = None
+) -> List[Award]:
+    rows = await _get_page("poap.awards", "issuer", issuer, limit, after)
     return [Award(**row) for row in rows]
 
 
-async def get_last_award_update_time() -> int:
-    row = await db.fetchone(
+async def stream_awards_poap(
+    badge_id: str, page_size: int = 500
+) -> AsyncIterator[Award]:
+    async for row in _stream_rows("poap.awards", "badge_id", badge_id, page_size):
+        yield Award(**row)
+
+
+async def stream_awards(issuer: str, page_size: int = 500) -> AsyncIterator[Award]:
+    async for row in _stream_rows("poap.awards", "issuer", issuer, page_size):
+        yield Award(**row)
+
+
+######################################## AWARD COUNTERS ########################################
+
+
+async def _count_awards(conn: Connection, rows: List[dict]) -> None:
+    """
+    Add the newly inserted award rows to the badge and issuer counters.
+    """
+    deltas: Dict[Tuple[str, str], list] = {}
+    for row in rows:
+        # a zero time is not known yet
+        created_at = row["event_created_at"] or None
+        for scope in [("badge", row["badge_id"]), ("issuer", row["issuer"])]:
+            delta = deltas.setdefault(scope, [0, None, None])
+            delta[0] += 1
+            if created_at:
+                delta[1] = min(delta[1] or created_at, created_at)
+                delta[2] = max(delta[2] or created_at, created_at)
+
+    for (scope, scope_id), (awards, first_award_at, last_award_at) in deltas.items():
+        await conn.execute(
+            """
+            INSERT INTO poap.award_counters (scope, scope_id, awards, first_award_at, last_award_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (scope, scope_id) DO UPDATE SET
+                awards = award_counters.awards + excluded.awards,
+                first_award_at = CASE
+                    WHEN award_counters.first_award_at IS NULL
+                        OR excluded.first_award_at < award_counters.first_award_at
+                    THEN excluded.first_award_at
+                    ELSE award_counters.first_award_at
+                END,
+                last_award_at = CASE
+                    WHEN award_counters.last_award_at IS NULL
+                        OR excluded.last_award_at > award_counters.last_award_at
+                    THEN excluded.last_award_at
+                    ELSE award_counters.last_award_at
+                END
+            """,
+            (scope, scope_id, awards, first_award_at, last_award_at),
+        )
+
+
+async def _delete_award_counters(conn: Connection, issuer_id: str) -> None:
+    await conn.execute(
         """
-            SELECT event_created_at FROM poap.awards 
-            ORDER BY event_created_at DESC LIMIT 1
+        DELETE FROM poap.award_counters
+        WHERE (scope = 'issuer' AND scope_id = ?)
+        OR (
+            scope = 'badge'
+            AND scope_id IN (SELECT badge_id FROM poap.awards WHERE issuer = ?)
+        )
         """,
-        (),
+        (issuer_id, issuer_id),
     )
-    return row[0] or 0 if row else 0
 
 
-async def update_award(award_id: str, data: CreateAward) -> Award:
-    await db.execute(
+async def get_award_counter(scope: str, scope_id: str) -> AwardCounter:
+    row = await db.fetchone(
+        "SELECT * FROM poap.award_counters WHERE scope = ? AND scope_id = ?",
+        (scope, scope_id),
+    )
+    return AwardCounter(**row) if row else AwardCounter(scope=scope, scope_id=scope_id)
+
+
+async def get_badge_award_counters(issuer_id: str) -> List[AwardCounter]:
+    rows = await db.fetchall(
         """
-        UPDATE poap.awards SET badge_id = ?, issuer = ?, claim_pubkey = ?, event_id = ?, event_created_at = ?
-        WHERE id = ?
+        SELECT c.* FROM poap.award_counters c
+        JOIN poap.badges b ON b.id = c.scope_id
+        WHERE c.scope = 'badge' AND b.issuer_id = ?
         """,
-        (
-            data.badge_id,
-            data.issuer,
-            data.claim_pubkey,
-            data.event_id,
-            data.event_created_at,
-            award_id,
-        ),
+        (issuer_id,),
+    )
+    return [AwardCounter(**row) for row in rows]
+
+
+async def rebuild_award_counters(issuer_id: str) -> None:
+    """
+    Recount the awards of the issuer and its badges from the awards table.
+    """
+    async with db.connect() as conn:
+        await _delete_award_counters(conn, issuer_id)
+        for scope, column in [("badge", "badge_id"), ("issuer", "issuer")]:
+            await conn.execute(
+                f"""
+                INSERT INTO poap.award_counters (scope, scope_id, awards, first_award_at, last_award_at)
+                SELECT '{scope}', {column}, COUNT(1),
+                    MIN(NULLIF(event_created_at, 0)), MAX(NULLIF(event_created_at, 0))
+                FROM poap.awards WHERE issuer = ?
+                GROUP BY {column}
+                """,
+                (issuer_id,),
+            )
+
+
+######################################## SYNC STATE ########################################
+
+
+async def get_sync_cursors() -> Dict[str, Dict[int, int]]:
+    rows = await db.fetchall(
+        "SELECT public_key, kind, last_created_at FROM poap.sync_state"
+    )
+    cursors: Dict[str, Dict[int, int]] = {}
+    for row in rows:
+        cursors.setdefault(row[0], {})[row[1]] = row[2]
+    return cursors
+
+
+async def upsert_sync_cursors(cursors: List[Tuple[str, int, int]]) -> None:
+    """
+    Store `(public_key, kind, last_created_at)` cursors in one transaction.
+    """
+    async with db.connect() as conn:
+        for public_key, kind, last_created_at in cursors:
+            await conn.execute(
+                """
+                INSERT INTO poap.sync_state (public_key, kind, last_created_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT (public_key, kind) DO UPDATE SET last_created_at = ?
+                """,
+                (public_key, kind, last_created_at, last_created_at),
+            )
+
+
+async def delete_sync_cursors(public_key: str) -> None:
+    await db.execute(
+        "DELETE FROM poap.sync_state WHERE public_key = ?",
+        (public_key,),
     )
-    return await get_award_poap(award_id)
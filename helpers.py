@@ -1,6 +1,8 @@
+import asyncio
 import base64
 import secrets
-from typing import Optional
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
 
 import secp256k1
 from bech32 import bech32_decode, convertbits
@@ -8,12 +10,88 @@ from cffi import FFI
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+from .cache import LRUCache
+
+# parsed private keys (and their secp256k1 context) by private key hex
+_signers = LRUCache(max_size=1_000)
+
+# NIP-04 shared secrets by (issuer public key, sender public key).
+# Kept in process memory only, never persisted.
+_shared_secrets = LRUCache(max_size=10_000, ttl=60 * 60)
+
+# Executor for the crypto work, keeps it off the event loop shared with LNbits.
+# Hashing and AES below `_inline_threshold` bytes run inline, the executor
+# round trip would cost more than the work itself.
+_crypto_executor: Optional[Executor] = None
+_inline_threshold = 16 * 1024
+
+
+def configure_crypto_executor(
+    mode: str = "thread", max_workers: int = 2, inline_threshold: int = 16 * 1024
+):
+    """
+    `mode` is one of `thread`, `process` or `inline` (no executor).
+    """
+    global _crypto_executor, _inline_threshold
+    assert mode in ("thread", "process", "inline"), f"Unknown mode '{mode}'"
+    if _crypto_executor:
+        _crypto_executor.shutdown(wait=False)
+    if mode == "thread":
+        _crypto_executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="poap-crypto"
+        )
+    elif mode == "process":
+        _crypto_executor = ProcessPoolExecutor(max_workers=max_workers)
+    else:
+        _crypto_executor = None
+    _inline_threshold = inline_threshold
+
+
+async def run_crypto(fn: Callable, *args, payload_size: Optional[int] = None) -> Any:
+    """
+    Run `fn` on the crypto executor. Elliptic curve operations are always
+    offloaded (`payload_size=None`), other work only for large payloads.
+    With a process pool `fn` and its arguments must be picklable.
+    """
+    if not _crypto_executor or (
+        payload_size is not None and payload_size < _inline_threshold
+    ):
+        return fn(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_crypto_executor, fn, *args)
+
 
 def get_shared_secret(privkey: str, pubkey: str):
     point = secp256k1.PublicKey(bytes.fromhex("02" + pubkey), True)
     return point.ecdh(bytes.fromhex(privkey), hashfn=copy_x)
 
 
+def get_cached_shared_secret(issuer_public_key: str, privkey: str, pubkey: str):
+    key = (issuer_public_key, pubkey)
+    secret = _shared_secrets.get(key)
+    if not secret:
+        secret = get_shared_secret(privkey, pubkey)
+        _shared_secrets.put(key, secret)
+    return secret
+
+
+async def get_cached_shared_secret_async(
+    issuer_public_key: str, privkey: str, pubkey: str
+):
+    key = (issuer_public_key, pubkey)
+    secret = _shared_secrets.get(key)
+    if not secret:
+        secret = await run_crypto(get_shared_secret, privkey, pubkey)
+        _shared_secrets.put(key, secret)
+    return secret
+
+
+def forget_shared_secrets(issuer_public_key: str):
+    for key in _shared_secrets.keys():
+        if key[0] == issuer_public_key:
+            _shared_secrets.pop(key)
+
+
 def decrypt_message(encoded_message: str, encryption_key) -> str:
     encoded_data = encoded_message.split("?iv=")
     if len(encoded_data) == 1:
@@ -46,12 +124,45 @@ def encrypt_message(message: str, encryption_key, iv: Optional[bytes] = None) ->
     return f"{base64.b64encode(encrypted_message).decode()}?iv={base64.b64encode(iv).decode()}"
 
 
+def get_signer(private_key: str) -> secp256k1.PrivateKey:
+    signer = _signers.get(private_key)
+    if not signer:
+        signer = secp256k1.PrivateKey(bytes.fromhex(private_key))
+        _signers.put(private_key, signer)
+    return signer
+
+
+def forget_signer(private_key: str):
+    _signers.pop(private_key)
+
+
 def sign_message_hash(private_key: str, hash: bytes) -> str:
-    privkey = secp256k1.PrivateKey(bytes.fromhex(private_key))
-    sig = privkey.schnorr_sign(hash, None, raw=True)
+    sig = get_signer(private_key).schnorr_sign(hash, None, raw=True)
     return sig.hex()
 
 
+def sign_message_hashes(private_key: str, hashes: List[bytes]) -> List[str]:
+    signer = get_signer(private_key)
+    return [signer.schnorr_sign(h, None, raw=True).hex() for h in hashes]
+
+
+async def decrypt_message_async(encoded_message: str, encryption_key) -> str:
+    return await run_crypto(
+        decrypt_message,
+        encoded_message,
+        encryption_key,
+        payload_size=len(encoded_message),
+    )
+
+
+async def sign_message_hash_async(private_key: str, hash: bytes) -> str:
+    return await run_crypto(sign_message_hash, private_key, hash)
+
+
+async def sign_message_hashes_async(private_key: str, hashes: List[bytes]) -> List[str]:
+    return await run_crypto(sign_message_hashes, private_key, hashes)
+
+
 def test_decrypt_encrypt(encoded_message: str, encryption_key):
     msg = decrypt_message(encoded_message, encryption_key)
 
@@ -90,3 +201,17 @@ def normalize_public_key(pubkey: str) -> str:
         raise ValueError("Public Key is not valid hex")
     int(pubkey, 16)
     return pubkey
+
+
+def encode_page_cursor(created_at: int, row_id: str) -> str:
+    return f"{created_at or 0}:{row_id}"
+
+
+def decode_page_cursor(cursor: str) -> Tuple[int, str]:
+    created_at, sep, row_id = cursor.partition(":")
+    if not sep or not row_id or not created_at.isdigit():
+        raise ValueError(f"Invalid page cursor '{cursor}'")
+    return int(created_at), row_id
+
+
+configure_crypto_executor()
@@ -1,3 +1,6 @@
+from lnbits.db import SQLITE
+
+
 async def m001_initial(db):
     """
     Initial issuers table.
@@ -48,3 +51,124 @@ async def m001_initial(db):
         );
         """
     )
+
+
+async def m002_sync_state(db):
+    """
+    Last seen event time for every issuer and event kind.
+    """
+    await db.execute(
+        """
+        CREATE TABLE poap.sync_state (
+            public_key TEXT NOT NULL,
+            kind INT NOT NULL,
+            last_created_at INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (public_key, kind)
+        );
+        """
+    )
+
+    """
+    Start from the events already stored.
+    Direct messages used to share the award cursor.
+    """
+    for kind, table, issuer_column in [
+        (30009, "badges", "issuer_id"),
+        (8, "awards", "issuer"),
+        (4, "awards", "issuer"),
+    ]:
+        await db.execute(
+            f"""
+            INSERT INTO poap.sync_state (public_key, kind, last_created_at)
+            SELECT i.public_key, {kind}, MAX(t.event_created_at)
+            FROM poap.{table} t JOIN poap.issuers i ON i.id = t.{issuer_column}
+            WHERE t.event_created_at IS NOT NULL
+            GROUP BY i.public_key
+            """
+        )
+
+
+def _create_index(db, name: str, table: str, columns: str, unique=False) -> str:
+    # SQLite puts the schema on the index name, Postgres on the table name
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    if db.type == SQLITE:
+        return f"CREATE {kind} IF NOT EXISTS poap.{name} ON {table} ({columns})"
+    return f"CREATE {kind} IF NOT EXISTS {name} ON poap.{table} ({columns})"
+
+
+async def m003_indexes(db):
+    """
+    Indexes for the lookups done on every event, claim and listing.
+    """
+    await db.execute(_create_index(db, "issuers_public_key", "issuers", "public_key"))
+    await db.execute(_create_index(db, "issuers_user_id", "issuers", "user_id"))
+    await db.execute(
+        _create_index(db, "badges_issuer", "badges", "issuer_id, event_created_at, id")
+    )
+    await db.execute(
+        _create_index(db, "awards_issuer", "awards", "issuer, event_created_at, id")
+    )
+    await db.execute(
+        _create_index(db, "awards_badge", "awards", "badge_id, event_created_at, id")
+    )
+
+    """
+    A badge can be awarded only once to a public key.
+    Keep one award of the existing duplicates.
+    """
+    await db.execute(
+        """
+        DELETE FROM poap.awards WHERE id NOT IN (
+            SELECT MIN(id) FROM poap.awards GROUP BY badge_id, claim_pubkey
+        )
+        """
+    )
+    await db.execute(
+        _create_index(
+            db, "awards_badge_claim", "awards", "badge_id, claim_pubkey", unique=True
+        )
+    )
+
+
+async def m004_event_created_at_not_null(db):
+    """
+    Listings are paginated on `(event_created_at, id)`, a NULL time would
+    drop the row from every page.
+    """
+    for table in ["badges", "awards"]:
+        await db.execute(
+            f"UPDATE poap.{table} SET event_created_at = 0 WHERE event_created_at IS NULL"
+        )
+
+
+async def m005_award_counters(db):
+    """
+    Award counts and times by badge and by issuer, kept up to date with
+    every award inserted.
+    """
+    await db.execute(
+        """
+        CREATE TABLE poap.award_counters (
+            scope TEXT NOT NULL,
+            scope_id TEXT NOT NULL,
+            awards INT NOT NULL DEFAULT 0,
+            first_award_at INT,
+            last_award_at INT,
+            PRIMARY KEY (scope, scope_id)
+        );
+        """
+    )
+
+    """
+    Count the awards already stored.
+    """
+    for scope, column in [("badge", "badge_id"), ("issuer", "issuer")]:
+        await db.execute(
+            f"""
+            INSERT INTO poap.award_counters (scope, scope_id, awards, first_award_at, last_award_at)
+            SELECT '{scope}', {column}, COUNT(1),
+                MIN(NULLIF(event_created_at, 0)), MAX(NULLIF(event_created_at, 0))
+            FROM poap.awards
+            GROUP BY {column}
+            """
+        )
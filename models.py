@@ -1,12 +1,20 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 from abc import abstractmethod
 from .nostr.event import NostrEvent
 import json
 import time
-import secp256k1
 from enum import Enum
-from .helpers import get_shared_secret, decrypt_message
+from .helpers import (
+    get_cached_shared_secret,
+    get_cached_shared_secret_async,
+    decrypt_message,
+    decrypt_message_async,
+    sign_message_hash,
+    sign_message_hash_async,
+    sign_message_hashes,
+    sign_message_hashes_async,
+)
 
 ######################################## NOSTR ########################################
 
@@ -35,14 +43,31 @@ class Issuer(BaseModel):
     meta: str
 
     def sign_hash(self, hash: bytes) -> str:
-        privkey = secp256k1.PrivateKey(bytes.fromhex(self.private_key))
-        sig = privkey.schnorr_sign(hash, None, raw=True)
-        return sig.hex()
+        return sign_message_hash(self.private_key, hash)
+
+    def sign_hashes(self, hashes: List[bytes]) -> List[str]:
+        return sign_message_hashes(self.private_key, hashes)
+
+    async def sign_hash_async(self, hash: bytes) -> str:
+        return await sign_message_hash_async(self.private_key, hash)
+
+    async def sign_hashes_async(self, hashes: List[bytes]) -> List[str]:
+        return await sign_message_hashes_async(self.private_key, hashes)
 
     def decrypt_message(self, encrypted_message: str, public_key: str) -> str:
-        encryption_key = get_shared_secret(self.private_key, public_key)
+        encryption_key = get_cached_shared_secret(
+            self.public_key, self.private_key, public_key
+        )
         return decrypt_message(encrypted_message, encryption_key)
 
+    async def decrypt_message_async(
+        self, encrypted_message: str, public_key: str
+    ) -> str:
+        encryption_key = await get_cached_shared_secret_async(
+            self.public_key, self.private_key, public_key
+        )
+        return await decrypt_message_async(encrypted_message, encryption_key)
+
 
 class CreatePOAP(BaseModel):
     id: Optional[str]
@@ -80,6 +105,14 @@ class POAP(CreatePOAP, Nostrable):
         return event
 
 
+class AwardCounter(BaseModel):
+    scope: str  # 'badge' or 'issuer'
+    scope_id: str
+    awards: int = 0
+    first_award_at: Optional[int]
+    last_award_at: Optional[int]
+
+
 class CreateAward(BaseModel):
     id: Optional[str]
     badge_id: str
@@ -1,10 +1,38 @@
 import hashlib
 import json
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 from secp256k1 import PublicKey
 
+# Reused encoder: `json.dumps` with arguments builds a new one on every call.
+# Same output as `json.dumps(..., separators=(",", ":"), ensure_ascii=False)`.
+_canonical_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
+def serialize_event(
+    pubkey: str, created_at: int, kind: int, tags: List[List[str]], content: str
+) -> str:
+    """
+    NIP-01 canonical serialization, used for the event id.
+    """
+    return _canonical_encoder.encode([0, pubkey, created_at, kind, tags, content])
+
+
+def check_signature(id: str, event_id: str, pubkey: str, sig: Optional[str]):
+    if id != event_id:
+        raise ValueError(f"Invalid event id. Expected: '{event_id}' got '{id}'")
+    try:
+        pub_key = PublicKey(bytes.fromhex("02" + pubkey), True)
+    except Exception:
+        raise ValueError(f"Invalid public key: '{pubkey}' for event '{id}'")
+
+    valid_signature = pub_key.schnorr_verify(
+        bytes.fromhex(event_id), bytes.fromhex(sig or ""), None, raw=True
+    )
+    if not valid_signature:
+        raise ValueError(f"Invalid signature: '{sig}' for event '{id}'")
+
 
 class NostrEvent(BaseModel):
     id: str = ""
@@ -15,37 +43,32 @@ class NostrEvent(BaseModel):
     content: str = ""
     sig: Optional[str]
 
+    # memoized id, reset when a serialized field is assigned.
+    # `tags` must not be changed in place.
+    _event_id: Optional[str] = PrivateAttr(default=None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in ("pubkey", "created_at", "kind", "tags", "content"):
+            super().__setattr__("_event_id", None)
+
     def serialize(self) -> List:
         return [0, self.pubkey, self.created_at, self.kind, self.tags, self.content]
 
     def serialize_json(self) -> str:
-        e = self.serialize()
-        return json.dumps(e, separators=(",", ":"), ensure_ascii=False)
+        return serialize_event(
+            self.pubkey, self.created_at, self.kind, self.tags, self.content
+        )
 
     @property
     def event_id(self) -> str:
-        data = self.serialize_json()
-        id = hashlib.sha256(data.encode()).hexdigest()
-        return id
+        if self._event_id is None:
+            data = self.serialize_json()
+            self._event_id = hashlib.sha256(data.encode()).hexdigest()
+        return self._event_id
 
     def check_signature(self):
-        event_id = self.event_id
-        if self.id != event_id:
-            raise ValueError(
-                f"Invalid event id. Expected: '{event_id}' got '{self.id}'"
-            )
-        try:
-            pub_key = PublicKey(bytes.fromhex("02" + self.pubkey), True)
-        except Exception:
-            raise ValueError(
-                f"Invalid public key: '{self.pubkey}' for event '{self.id}'"
-            )
-
-        valid_signature = pub_key.schnorr_verify(
-            bytes.fromhex(event_id), bytes.fromhex(self.sig), None, raw=True
-        )
-        if not valid_signature:
-            raise ValueError(f"Invalid signature: '{self.sig}' for event '{self.id}'")
+        check_signature(self.id, self.event_id, self.pubkey, self.sig)
 
     def stringify(self) -> str:
         return json.dumps(dict(self))
@@ -55,3 +78,82 @@ class NostrEvent(BaseModel):
 
     def has_tag_value(self, tag_name: str, tag_value: str) -> bool:
         return tag_value in self.tag_values(tag_name)
+
+
+class IngestEvent:
+    """
+    Compact event for the ingest path, built from relay data without
+    validation. `NostrEvent` is for the API and for the events we publish.
+    Tags are indexed by name the first time they are looked up.
+    """
+
+    __slots__ = (
+        "id",
+        "pubkey",
+        "created_at",
+        "kind",
+        "tags",
+        "content",
+        "sig",
+        "_tag_index",
+        "_event_id",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        pubkey: str,
+        created_at: int,
+        kind: int,
+        tags: List[List[str]],
+        content: str = "",
+        sig: Optional[str] = None,
+    ):
+        self.id = id
+        self.pubkey = pubkey
+        self.created_at = created_at
+        self.kind = kind
+        self.tags = tags
+        self.content = content
+        self.sig = sig
+        self._tag_index: Optional[Dict[str, List[str]]] = None
+        self._event_id: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "IngestEvent":
+        return cls(
+            data["id"],
+            data["pubkey"],
+            data["created_at"],
+            data["kind"],
+            data.get("tags") or [],
+            data.get("content") or "",
+            data.get("sig"),
+        )
+
+    def serialize_json(self) -> str:
+        return serialize_event(
+            self.pubkey, self.created_at, self.kind, self.tags, self.content
+        )
+
+    @property
+    def event_id(self) -> str:
+        if self._event_id is None:
+            data = self.serialize_json()
+            self._event_id = hashlib.sha256(data.encode()).hexdigest()
+        return self._event_id
+
+    def check_signature(self):
+        check_signature(self.id, self.event_id, self.pubkey, self.sig)
+
+    def tag_values(self, tag_name: str) -> List[str]:
+        if self._tag_index is None:
+            index: Dict[str, List[str]] = {}
+            for t in self.tags:
+                if len(t) > 1:
+                    index.setdefault(t[0], []).append(t[1])
+            self._tag_index = index
+        return self._tag_index.get(tag_name, [])
+
+    def has_tag_value(self, tag_name: str, tag_value: str) -> bool:
+        return tag_value in self.tag_values(tag_name)
@@ -0,0 +1,45 @@
+import json
+import re
+from typing import Any, Optional, Tuple
+
+try:
+    import orjson
+
+    def json_loads(data: str) -> Any:
+        return orjson.loads(data)
+
+except ImportError:
+    json_loads = json.loads
+
+
+# `["TYPE", "first string argument"` at the start of a relay message
+_HEAD_RE = re.compile(r'\s*\[\s*"([A-Za-z]+)"\s*(?:,\s*"((?:[^"\\]|\\.)*)")?')
+
+# A `"kind"` key can only be preceded by `{` or `,` when it is a real key:
+# inside a JSON string the quote would be escaped.
+_KIND_RE = re.compile(r'[{,]\s*"kind"\s*:\s*(\d+)')
+_ID_RE = re.compile(r'[{,]\s*"id"\s*:\s*"([0-9a-fA-F]{64})"')
+
+
+def classify_message(
+    msg: str,
+) -> Tuple[str, Optional[str], Optional[int], Optional[str]]:
+    """
+    Read the message type, the first argument (the subscription id for
+    `EVENT` and `EOSE`) and, for events, the kind and the event id without
+    parsing the frame.
+    """
+    head = _HEAD_RE.match(msg)
+    if not head:
+        raise ValueError(f"Invalid nostr message: '{msg[:64]}'")
+    msg_type = head.group(1).upper()
+    first_arg = head.group(2)
+
+    kind, event_id = None, None
+    if msg_type == "EVENT":
+        match = _KIND_RE.search(msg, head.end())
+        kind = int(match.group(1)) if match else None
+        match = _ID_RE.search(msg, head.end())
+        event_id = match.group(1).lower() if match else None
+
+    return msg_type, first_arg, kind, event_id
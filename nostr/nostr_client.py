@@ -1,65 +1,441 @@
 import asyncio
 import json
+import random
+import time
 from asyncio import Queue
+from collections import deque
 from threading import Thread
-from typing import Callable, List
+from typing import Awaitable, Callable, Coroutine, Deque, Dict, List, Optional
 
+import websockets
 from loguru import logger
 from websocket import WebSocketApp
+from websockets.exceptions import ConnectionClosed
 
 from lnbits.app import settings
-from lnbits.helpers import encrypt_internal_message, urlsafe_short_hash
+from lnbits.helpers import encrypt_internal_message
 
+from ..cache import LRUCache
 from .event import NostrEvent
+from .message import classify_message, json_loads
+from .publish import LatencyStats, PublishAck
+from .subscriptions import IssuerShard, ShardEose, TempSubscription
 
 
 class NostrClient:
-    def __init__(self):
-        self.recieve_event_queue: Queue = Queue()
-        self.send_req_queue: Queue = Queue()
-        self.ws: WebSocketApp = None
-        self.subscription_id = "poap-" + urlsafe_short_hash()[:32]
+    """
+    Client for the 'nostrclient' extension relay multiplexer.
+
+    Two transports are supported:
+     - `asyncio` (default): the websocket is read and written from the event
+       loop, so incoming messages are queued without a thread hop and a full
+       queue naturally stops the reads.
+     - `thread`: the legacy `WebSocketApp` running in a daemon thread. Messages
+       are handed over to the event loop thread-safely.
+
+    Both queues are bounded. `OK` and `CLOSED` replies are handled as they
+    are read, they never wait for room in the inbound queue: events that do
+    not fit yet wait in a read-ahead buffer of the same size. When the
+    inbound queue is full the `overflow_policy` decides what happens:
+     - `block`: stop reading from the websocket once the read-ahead buffer
+       is full too, until there is room.
+     - `drop_backfill`: discard the incoming events of shards that are still
+       backfilling (live events still block). Such a shard does not move its
+       cursors at EOSE, it is fetched again instead, and that second backfill
+       blocks so it always completes.
+
+    Issuers are subscribed in shards of at most `shard_size` public keys,
+    many relays reject filters with too many authors.
+
+    A lost connection is retried with jittered exponential backoff. The
+    request being sent is kept and re-sent, and the open subscriptions are
+    re-established after reconnecting.
+    """
+
+    def __init__(
+        self,
+        transport: str = "asyncio",
+        recieve_queue_size: int = 10_000,
+        send_queue_size: int = 1_000,
+        overflow_policy: str = "block",
+        shard_size: int = 250,
+        connect_timeout: float = 10,
+        backoff_base: float = 0.5,
+        backoff_max: float = 60,
+        startup_retries: int = 10,
+    ):
+        assert transport in ("asyncio", "thread"), f"Unknown transport '{transport}'"
+        assert overflow_policy in (
+            "block",
+            "drop_backfill",
+        ), f"Unknown overflow policy '{overflow_policy}'"
+        self.transport = transport
+        self.overflow_policy = overflow_policy
+        self.shard_size = shard_size
+        self.connect_timeout = connect_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.startup_retries = startup_retries
+        self.connections = 0
+        self.created_at = time.monotonic()
+        # seconds from creation to the first open connection
+        self.first_connected_after: Optional[float] = None
+        self.recieve_event_queue: Queue = Queue(maxsize=recieve_queue_size)
+        # read but not queued yet, in order, see `_queue_message`
+        self._read_ahead: Deque = deque()
+        self._read_ahead_room = asyncio.Event()
+        self._forward_task: Optional[asyncio.Task] = None
+        self.send_req_queue: Queue = Queue(maxsize=send_queue_size)
+        self.recieve_high_water = 0
+        self.send_high_water = 0
+        self.dropped_messages = 0
+        self.ws = None
+        self.shards: List[IssuerShard] = []
+        self._issuer_shards: Dict[str, IssuerShard] = {}
+        # called after a shard has received EOSE
+        self.on_eose: Optional[Callable[[IssuerShard], Awaitable]] = None
+        self.temp_subscriptions: Dict[str, TempSubscription] = {}
+        self._temp_timer: Optional[asyncio.TimerHandle] = None
+        # published events waiting for relay `OK` messages
+        self._publish_acks = LRUCache(max_size=10_000, ttl=10 * 60)
+        self.publish_latency = LatencyStats()
+        self.publish_rejections = 0
         self.running = False
+        self._ws_open = False
+        self._ws_ready = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        # the `WebSocketApp` whose callbacks are listened to
+        self._thread_ws: Optional[WebSocketApp] = None
+        # taken from `send_req_queue` but not sent yet
+        self._pending_req: Optional[str] = None
 
     @property
     def is_websocket_connected(self):
         if not self.ws:
             return False
-        return self.ws.keep_running
+        return self._ws_open
 
-    async def connect_to_nostrclient_ws(self) -> WebSocketApp:
+    @property
+    def relay_url(self) -> str:
+        relay_endpoint = encrypt_internal_message("relay")
+        return f"ws://localhost:{settings.port}/nostrclient/api/v1/{relay_endpoint}"
+
+    async def connect_to_nostrclient_ws(self):
         logger.debug(f"Connecting to websockets for 'nostrclient' extension...")
+        if self.transport == "thread":
+            return await self._connect_thread_ws()
+        return await self._connect_asyncio_ws()
+
+    async def _connect_asyncio_ws(self):
+        ws = await asyncio.wait_for(
+            websockets.connect(self.relay_url, max_size=None),
+            timeout=self.connect_timeout,
+        )
+        self._set_ws_open(True)
+        logger.info("Connected to 'nostrclient' websocket")
+        self._reader_task = asyncio.create_task(self._read_forever(ws))
+        return ws
 
-        relay_endpoint = encrypt_internal_message("relay")
+    async def _read_forever(self, ws):
+        try:
+            async for message in ws:
+                # waits only while the read-ahead buffer is full
+                await self._enqueue_message(message)
+        except ConnectionClosed as ex:
+            logger.warning(f"Websocket closed: '{ex.code}' '{ex.reason}'")
+        except asyncio.CancelledError:
+            return
+        except Exception as ex:
+            logger.warning(ex)
+
+        # a reader cancelled by `_close_ws` must not touch the next connection
+        if self._reader_task is not asyncio.current_task():
+            return
+        self._set_ws_open(False)
+        if self.running:
+            # `run_forever` reconnects and restores the subscriptions
+            self._wake_up()
+
+    async def _connect_thread_ws(self) -> WebSocketApp:
+        self._loop = asyncio.get_running_loop()
+        self._set_ws_open(False)
         on_open, on_message, on_error, on_close = self._ws_handlers()
         ws = WebSocketApp(
-            f"ws://localhost:{settings.port}/nostrclient/api/v1/{relay_endpoint}",
+            self.relay_url,
             on_message=on_message,
             on_open=on_open,
             on_close=on_close,
             on_error=on_error,
         )
+        self._thread_ws = ws
 
         wst = Thread(target=ws.run_forever)
         wst.daemon = True
         wst.start()
 
+        # wait for `on_open`
+        try:
+            await asyncio.wait_for(self._ws_ready.wait(), timeout=self.connect_timeout)
+        except asyncio.TimeoutError:
+            ws.close()
+            raise ConnectionError("Timeout connecting to 'nostrclient' websocket")
+
         return ws
 
+    async def wait_until_connected(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the websocket to 'nostrclient' is open.
+        """
+        try:
+            await asyncio.wait_for(self._ws_ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _set_ws_open(self, is_open: bool):
+        self._ws_open = is_open
+        if is_open:
+            self._ws_ready.set()
+        else:
+            self._ws_ready.clear()
+
+    def _backoff_delay(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        return delay * random.uniform(0.5, 1)
+
     async def run_forever(self):
         self.running = True
-        while self.running:
-            try:
-                if not self.is_websocket_connected:
-                    self.ws = await self.connect_to_nostrclient_ws()
-                    # be sure the connection is open
-                    await asyncio.sleep(5)
+        attempt = 0
+        try:
+            while self.running:
+                try:
+                    if not self.is_websocket_connected:
+                        await self._close_ws()
+                        self.ws = await self.connect_to_nostrclient_ws()
+                        self.connections += 1
+                        if self.connections > 1:
+                            await self._restore_subscriptions()
+                        else:
+                            self.first_connected_after = (
+                                time.monotonic() - self.created_at
+                            )
+                            logger.info(
+                                f"Connected to 'nostrclient' {self.first_connected_after:.2f} seconds after start"
+                            )
+                        attempt = 0
+
+                    if self._pending_req is None:
+                        req = await self.send_req_queue.get()
+                        if req is None:
+                            continue
+                        self._pending_req = self._serialize_req(req)
+
+                    if not self.is_websocket_connected or not self._pending_req:
+                        continue
+                    await self._send(self._pending_req)
+                    self._pending_req = None
+                except Exception as ex:
+                    # force a reconnect, the pending request is sent afterwards
+                    await self._close_ws()
+                    delay = self._backoff_delay(attempt)
+                    attempt += 1
+                    if self.connections == 0 and attempt == self.startup_retries:
+                        logger.error(
+                            f"The 'nostrclient' extension is not ready after {attempt} attempts. Is it enabled?"
+                        )
+                    logger.warning(f"{ex}. Retrying in {delay:.1f} seconds.")
+                    await asyncio.sleep(delay)
+        finally:
+            self.running = False
+            await self._close_ws()
+
+    def _serialize_req(self, req: List) -> Optional[str]:
+        try:
+            return json.dumps(req)
+        except Exception as ex:
+            logger.warning(f"Dropping invalid request: {ex}")
+            return None
+
+    async def _restore_subscriptions(self):
+        for shard in self.shards:
+            if shard.is_open:
+                await self._send(json.dumps(self._shard_req(shard)))
+                shard.mark_open()
+        for temp_subscription in self.temp_subscriptions.values():
+            req = ["REQ", temp_subscription.subscription_id] + temp_subscription.filters
+            await self._send(json.dumps(req))
+        logger.info(
+            f"Restored {len(self.shards)} shards and {len(self.temp_subscriptions)} temp subscriptions"
+        )
 
-                req = await self.send_req_queue.get()
-                self.ws.send(json.dumps(req))
-            except Exception as ex:
-                logger.warning(ex)
-                await asyncio.sleep(60)
+    async def _send(self, data: str):
+        if self.transport == "thread":
+            self.ws.send(data)
+        else:
+            await self.ws.send(data)
+
+    def _wake_up(self):
+        # unblock `run_forever` so it can reconnect or exit
+        try:
+            self.send_req_queue.put_nowait(None)
+        except asyncio.QueueFull:
+            # `run_forever` is not waiting, it will check the state soon anyway
+            pass
+
+    async def _enqueue_message(self, message: str):
+        if message.startswith('["EOSE"'):
+            await self._handle_eose(message)
+            return
+        if message.startswith('["CLOSED"'):
+            await self._handle_closed(message)
+            return
+        if message.startswith('["OK"'):
+            self._handle_ok(message)
+            return
+        if self.temp_subscriptions and not self._collect_temp_event(message):
+            return
+
+        queue_full = self._read_ahead or self.recieve_event_queue.full()
+        if queue_full and self.overflow_policy == "drop_backfill":
+            shard = self._backfill_shard(message)
+            if shard:
+                shard.dropped_events += 1
+                self.dropped_messages += 1
+                return
+
+        await self._queue_message(message)
+
+    async def _queue_message(self, item):
+        """
+        Queue an event or an EOSE marker for ingest, keeping the order.
+        Items wait in the read-ahead buffer while the queue is full, the
+        reads stop only once that buffer is full too.
+        """
+        queue = self.recieve_event_queue
+        if not self._read_ahead and not queue.full():
+            queue.put_nowait(item)
+            self.recieve_high_water = max(self.recieve_high_water, queue.qsize())
+            return
+
+        self._read_ahead.append(item)
+        if not self._forward_task or self._forward_task.done():
+            self._forward_task = asyncio.create_task(self._forward_read_ahead())
+        while len(self._read_ahead) >= queue.maxsize:
+            self._read_ahead_room.clear()
+            await self._read_ahead_room.wait()
+
+    async def _forward_read_ahead(self):
+        queue = self.recieve_event_queue
+        while self._read_ahead:
+            # the item stays in the buffer until it is queued, for the order
+            await queue.put(self._read_ahead[0])
+            self._read_ahead.popleft()
+            self._read_ahead_room.set()
+            self.recieve_high_water = max(self.recieve_high_water, queue.qsize())
+
+    async def _queue_req(self, req: List):
+        await self.send_req_queue.put(req)
+        self.send_high_water = max(self.send_high_water, self.send_req_queue.qsize())
+
+    async def _handle_eose(self, message: str):
+        try:
+            _, subscription_id, _, _ = classify_message(message)
+            temp_subscription = self.temp_subscriptions.get(subscription_id or "")
+            if temp_subscription:
+                await self._close_temp_subscription(temp_subscription)
+                return
+
+            shard = self._find_shard(subscription_id)
+            if not shard or shard.is_live:
+                return
+            # behind the events still waiting to be handled, see `complete_shard_eose`
+            await self._queue_message(ShardEose(shard))
+        except Exception as ex:
+            logger.debug(ex)
+
+    async def complete_shard_eose(self, eose: ShardEose):
+        """
+        Call once every event received before the EOSE has been handled.
+        """
+        if not eose.is_current():
+            return
+        shard = eose.shard
+        if shard.dropped_events:
+            # the cursors stay put, the shard is fetched again without drops
+            shard.can_drop_events = False
+            delay = self._schedule_shard_retry(shard)
+            logger.warning(
+                f"Dropped {shard.dropped_events} backfill events of '{shard.subscription_id}'. Fetching again in {delay:.1f} seconds."
+            )
+            return
+        shard.on_eose()
+        if self.on_eose:
+            await self.on_eose(shard)
+
+    async def _handle_closed(self, message: str):
+        """
+        A relay refused or ended a subscription (rate limited, auth required...).
+        Temp subscriptions are done. Issuer shards are re-opened with backoff,
+        their cursors do not move: nothing was received.
+        """
+        try:
+            _, subscription_id, _, _ = classify_message(message)
+            temp_subscription = self.temp_subscriptions.get(subscription_id or "")
+            if temp_subscription:
+                await self._close_temp_subscription(temp_subscription)
+                return
+
+            shard = self._find_shard(subscription_id)
+            if not shard or not shard.is_open:
+                return
+            shard.mark_closed()
+            delay = self._schedule_shard_retry(shard)
+            logger.warning(
+                f"Subscription '{subscription_id}' closed by relay: {message[:256]}. Retrying in {delay:.1f} seconds."
+            )
+        except Exception as ex:
+            logger.debug(ex)
+
+    def _schedule_shard_retry(self, shard: IssuerShard) -> float:
+        delay = self._backoff_delay(shard.retries)
+        shard.retries += 1
+        subscription_id = shard.subscription_id
+        asyncio.get_running_loop().call_later(
+            delay,
+            lambda: asyncio.create_task(self._retry_shard(shard, subscription_id)),
+        )
+        return delay
+
+    async def _retry_shard(self, shard: IssuerShard, subscription_id: str):
+        # skip if the shard was removed or re-opened in the meantime
+        if shard in self.shards and shard.subscription_id == subscription_id:
+            await self.reopen_shard(shard)
+
+    def _backfill_shard(self, message: str) -> Optional[IssuerShard]:
+        # the shard of an event received before its EOSE
+        try:
+            type, subscription_id, _, _ = classify_message(message)
+        except ValueError:
+            return None
+        if type != "EVENT":
+            return None
+        shard = self._find_shard(subscription_id)
+        if not shard or shard.is_live or not shard.can_drop_events:
+            return None
+        return shard
+
+    def _find_shard(self, subscription_id: Optional[str]) -> Optional[IssuerShard]:
+        return next(
+            (s for s in self.shards if s.subscription_id == subscription_id), None
+        )
+
+    def is_issuer_live(self, public_key: str) -> bool:
+        """
+        True once the stored events of the issuer have all been received.
+        """
+        shard = self._issuer_shards.get(public_key)
+        return shard.is_live if shard else False
 
     async def get_event(self):
         value = await self.recieve_event_queue.get()
@@ -67,64 +443,282 @@ class NostrClient:
             raise value
         return value
 
-    async def publish_nostr_event(self, e: NostrEvent):
-        await self.send_req_queue.put(["EVENT", e.dict()])
+    async def publish_nostr_event(
+        self, e: NostrEvent, wait_for_ok: int = 0, timeout: float = 5
+    ) -> bool:
+        """
+        Publish the event. With `wait_for_ok` set, wait until that many relays
+        have accepted it. Returns `False` if not enough relays accepted it in
+        time and raises `ValueError` if it was only rejected.
+        """
+        ack = PublishAck(e.id, wait_for_ok)
+        self._publish_acks.put(e.id, ack)
+        await self._queue_req(["EVENT", e.dict()])
+        if not wait_for_ok:
+            return True
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(ack.future), timeout)
+        except asyncio.TimeoutError:
+            if ack.rejections and not ack.accepted:
+                raise ValueError(
+                    f"Event '{e.id}' rejected by relays: {', '.join(ack.rejections)}"
+                )
+            logger.warning(
+                f"Event '{e.id}' accepted by {ack.accepted} of {wait_for_ok} relays"
+            )
+            return False
+
+    def _handle_ok(self, message: str):
+        try:
+            _, event_id, accepted, *rest = json_loads(message)
+            ack: Optional[PublishAck] = self._publish_acks.get(event_id)
+            if not ack:
+                return
+            if not accepted:
+                self.publish_rejections += 1
+                logger.warning(f"Event '{event_id}' rejected: {rest}")
+            latency = ack.on_ok(accepted, str(rest[0]) if rest else "")
+            if latency is not None:
+                self.publish_latency.add(latency)
+        except Exception as ex:
+            logger.debug(ex)
+
+    def stats(self) -> dict:
+        return {
+            "transport": self.transport,
+            "connected": self.is_websocket_connected,
+            "reconnects": max(self.connections - 1, 0),
+            "first_connected_after": self.first_connected_after,
+            "overflow_policy": self.overflow_policy,
+            "shards": [
+                {
+                    "subscription_id": shard.subscription_id,
+                    "public_keys": shard.size,
+                    "open": shard.is_open,
+                    "live": shard.is_live,
+                    "dropped": shard.dropped_events,
+                }
+                for shard in self.shards
+            ],
+            "recieve_queue": {
+                "depth": self.recieve_event_queue.qsize(),
+                "maxsize": self.recieve_event_queue.maxsize,
+                "read_ahead": len(self._read_ahead),
+                "high_water": self.recieve_high_water,
+                "dropped": self.dropped_messages,
+            },
+            "send_queue": {
+                "depth": self.send_req_queue.qsize(),
+                "maxsize": self.send_req_queue.maxsize,
+                "high_water": self.send_high_water,
+            },
+            "publish": {
+                "latency": self.publish_latency.stats(),
+                "rejections": self.publish_rejections,
+            },
+        }
 
     async def subscribe_issuers(
         self,
         public_keys: List[str],
-        badge_time=0,
-        award_time=0,
-        dm_time=0,
+        cursors: Optional[Dict[str, Dict[int, int]]] = None,
     ):
-        badge_filters = self._filters_for_badge_events(public_keys, badge_time)
-        award_filters = self._filters_for_award_events(public_keys, award_time)
-        dm_filters = self._filters_for_direct_messages(public_keys, dm_time)
-
-        merchant_filters = badge_filters + award_filters + dm_filters
+        """
+        `cursors` maps each public key to the last seen `created_at` by kind.
+        """
+        await self.unsubscribe_issuers()
 
-        self.subscription_id = "poap-" + urlsafe_short_hash()[:32]
-        await self.send_req_queue.put(["REQ", self.subscription_id] + merchant_filters)
+        cursors = cursors or {}
+        # issuers with similar cursors share a shard, this keeps replays short
+        public_keys = sorted(
+            public_keys,
+            key=lambda pk: min(cursors[pk].values() or [0]) if pk in cursors else 0,
+        )
+        self.shards = [
+            IssuerShard.from_cursors(public_keys[i : i + self.shard_size], cursors)
+            for i in range(0, len(public_keys), self.shard_size)
+        ]
+        self._issuer_shards = {
+            pk: shard
+            for shard in self.shards
+            for pk in shard.public_keys + shard.new_public_keys
+        }
+        for shard in self.shards:
+            await self.open_shard(shard)
 
         logger.debug(
-            f"Subscribed to events for: {len(public_keys)} keys. New subscription id: {self.subscription_id}"
+            f"Subscribed to events for: {len(public_keys)} keys in {len(self.shards)} shards."
         )
 
-    async def issuer_temp_subscription(self, pk, duration=10):
+    async def add_issuer(self, public_key: str):
+        """
+        Subscribe to the events of one more issuer.
+        Only the shard that gets the new public key is re-opened.
+        """
+        if public_key in self._issuer_shards:
+            return
+        shard = next((s for s in self.shards if s.size < self.shard_size), None)
+        if not shard:
+            shard = IssuerShard([])
+            self.shards.append(shard)
+
+        shard.add_public_key(public_key)
+        self._issuer_shards[public_key] = shard
+        await self.reopen_shard(shard)
+        logger.debug(f"Subscribed issuer '{public_key}' in shard {shard.subscription_id}")
+
+    async def remove_issuer(self, public_key: str):
+        shard = self._issuer_shards.pop(public_key, None)
+        if not shard:
+            return
+
+        shard.remove_public_key(public_key)
+        if shard.size == 0:
+            self.shards.remove(shard)
+            await self.close_shard(shard)
+        else:
+            await self.reopen_shard(shard)
+        logger.debug(f"Unsubscribed issuer '{public_key}'")
+
+    async def reopen_shard(self, shard: IssuerShard):
+        # a fresh id avoids relays merging the old and the new filters
+        await self.close_shard(shard)
+        shard.renew_subscription_id()
+        await self.open_shard(shard)
+
+    async def open_shard(self, shard: IssuerShard):
+        req = self._shard_req(shard)
+        shard.mark_open()
+        await self._queue_req(req)
+
+    def _shard_req(self, shard: IssuerShard) -> List:
+        issuer_filters = []
+        if shard.public_keys:
+            issuer_filters += self._filters_for_badge_events(
+                shard.public_keys, shard.badge_time
+            )
+            issuer_filters += self._filters_for_award_events(
+                shard.public_keys, shard.award_time
+            )
+            issuer_filters += self._filters_for_direct_messages(
+                shard.public_keys, shard.dm_time
+            )
+        if shard.new_public_keys:
+            # new issuers get their full history
+            issuer_filters += self._filters_for_badge_events(shard.new_public_keys, 0)
+            issuer_filters += self._filters_for_award_events(shard.new_public_keys, 0)
+            issuer_filters += self._filters_for_direct_messages(
+                shard.new_public_keys, 0
+            )
+
+        return ["REQ", shard.subscription_id] + issuer_filters
+
+    async def close_shard(self, shard: IssuerShard):
+        if not shard.is_open:
+            return
+        shard.mark_closed()
+        await self._queue_req(["CLOSE", shard.subscription_id])
+
+    async def issuer_temp_subscription(self, pk, duration=10) -> List[dict]:
+        """
+        Fetch all the events of an issuer. The events are also ingested.
+        Returns as soon as the relays are done (EOSE) or after `duration`.
+        """
         badge_filters = self._filters_for_badge_events([pk], 0)
         award_filters = self._filters_for_award_events([pk], 0)
         dm_filters = self._filters_for_direct_messages([pk], 0)
 
         issuer_filters = badge_filters + award_filters + dm_filters
 
-        subscription_id = "issuer-" + urlsafe_short_hash()[:32]
-        logger.debug(
-            f"New issuer temp subscription ({duration} sec). Subscription id: {subscription_id}"
+        return await self.temp_subscribe(
+            "issuer", issuer_filters, duration, forward=True
         )
-        await self.send_req_queue.put(["REQ", subscription_id] + issuer_filters)
-
-        async def unsubscribe_with_delay(sub_id, d):
-            await asyncio.sleep(d)
-            await self.unsubscribe(sub_id)
-
-        asyncio.create_task(unsubscribe_with_delay(subscription_id, duration))
 
     async def user_profile_temp_subscribe(self, public_key: str, duration=5) -> List:
         try:
             profile_filter = [{"kinds": [30008], "authors": [public_key]}]
-            subscription_id = "profile-" + urlsafe_short_hash()[:32]
-            logger.debug(
-                f"New user temp subscription ({duration} sec). Subscription id: {subscription_id}"
-            )
-            await self.send_req_queue.put(["REQ", subscription_id] + profile_filter)
+            return await self.temp_subscribe("profile", profile_filter, duration)
+        except Exception as ex:
+            logger.debug(ex)
+            return []
+
+    async def temp_subscribe(
+        self, prefix: str, filters: List[dict], duration: float, forward=False
+    ) -> List[dict]:
+        future = await self.open_temp_subscription(prefix, filters, duration, forward)
+        # the future can be shared by other callers
+        return await asyncio.shield(future)
+
+    async def open_temp_subscription(
+        self, prefix: str, filters: List[dict], duration: float, forward=False
+    ) -> asyncio.Future:
+        """
+        Open a temporary subscription. The returned future resolves to the
+        collected events once EOSE is received or `duration` has passed.
+        Identical concurrent subscriptions share the same future.
+        """
+        key = TempSubscription.key_for(filters, forward)
+        for temp_subscription in self.temp_subscriptions.values():
+            if temp_subscription.key == key:
+                return temp_subscription.future
+
+        loop = asyncio.get_running_loop()
+        temp_subscription = TempSubscription(
+            prefix, filters, loop.time() + duration, forward
+        )
+        self.temp_subscriptions[temp_subscription.subscription_id] = temp_subscription
+        self._schedule_temp_timer()
+        logger.debug(
+            f"New temp subscription ({duration} sec). Subscription id: {temp_subscription.subscription_id}"
+        )
+        await self._queue_req(["REQ", temp_subscription.subscription_id] + filters)
 
-            async def unsubscribe_with_delay(sub_id, d):
-                await asyncio.sleep(d)
-                await self.unsubscribe(sub_id)
+        return temp_subscription.future
 
-            asyncio.create_task(unsubscribe_with_delay(subscription_id, duration))
+    def _collect_temp_event(self, message: str) -> bool:
+        """
+        Keep the events of temporary subscriptions.
+        Returns `True` if the message must still be queued for ingest.
+        """
+        try:
+            type, subscription_id, _, _ = classify_message(message)
+            temp_subscription = self.temp_subscriptions.get(subscription_id or "")
+            if type != "EVENT" or not temp_subscription:
+                return True
+            _, _, event = json_loads(message)
+            temp_subscription.events.append(event)
+            return temp_subscription.forward
         except Exception as ex:
             logger.debug(ex)
+            return True
+
+    async def _close_temp_subscription(self, temp_subscription: TempSubscription):
+        if not self.temp_subscriptions.pop(temp_subscription.subscription_id, None):
+            return
+        temp_subscription.done()
+        await self.unsubscribe(temp_subscription.subscription_id)
+
+    def _schedule_temp_timer(self):
+        # a single timer for all temp subscriptions, set to the closest deadline
+        if self._temp_timer:
+            self._temp_timer.cancel()
+            self._temp_timer = None
+        if not self.temp_subscriptions:
+            return
+        deadline = min(s.deadline for s in self.temp_subscriptions.values())
+        loop = asyncio.get_running_loop()
+        self._temp_timer = loop.call_at(
+            deadline, lambda: asyncio.create_task(self._expire_temp_subscriptions())
+        )
+
+    async def _expire_temp_subscriptions(self):
+        self._temp_timer = None
+        now = asyncio.get_running_loop().time()
+        expired = [s for s in self.temp_subscriptions.values() if s.deadline <= now]
+        for temp_subscription in expired:
+            await self._close_temp_subscription(temp_subscription)
+        self._schedule_temp_timer()
 
     def _filters_for_badge_events(self, public_keys: List[str], since: int) -> List:
         badge_filter = {"kinds": [30009], "authors": public_keys}
@@ -147,32 +741,69 @@ class NostrClient:
 
         return [in_messages_filter]
 
-    def _safe_ws_stop(self):
-        if not self.ws:
+    async def _close_ws(self):
+        ws, self.ws = self.ws, None
+        self._thread_ws = None
+        self._set_ws_open(False)
+        if self._reader_task:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if not ws:
             return
         try:
-            self.ws.close()
+            if self.transport == "thread":
+                ws.close()
+            else:
+                await ws.close()
         except:
             pass
-        self.ws = None
+
+    def _to_loop(self, fn: Callable, *args):
+        # the `WebSocketApp` callbacks run on its own thread
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    def _run_in_loop(self, coro: Coroutine, wait=False):
+        if not self._loop or self._loop.is_closed():
+            coro.close()
+            return
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        if wait:
+            try:
+                future.result()
+            except Exception as ex:
+                logger.warning(ex)
 
     def _ws_handlers(self):
-        def on_open(_):
+        # callbacks get their `WebSocketApp`: the late ones of a replaced
+        # socket must not close the new connection
+        def on_open(ws):
             logger.info("Connected to 'nostrclient' websocket")
+            self._to_loop(self._on_thread_ws_state, ws, True)
 
-        def on_message(_, message):
-            self.recieve_event_queue.put_nowait(message)
+        def on_message(ws, message):
+            if ws is not self._thread_ws:
+                return
+            # block the websocket thread while the queue is full
+            self._run_in_loop(self._enqueue_message(message), wait=True)
 
         def on_error(_, error):
             logger.warning(error)
 
-        def on_close(x, status_code, message):
-            logger.warning(f"Websocket closed: {x}: '{status_code}' '{message}'")
-            # force re-subscribe
-            self.recieve_event_queue.put_nowait(ValueError("Websocket close."))
+        def on_close(ws, status_code, message):
+            logger.warning(f"Websocket closed: {ws}: '{status_code}' '{message}'")
+            self._to_loop(self._on_thread_ws_state, ws, False)
 
         return on_open, on_message, on_error, on_close
 
+    def _on_thread_ws_state(self, ws: WebSocketApp, is_open: bool):
+        if ws is not self._thread_ws:
+            return
+        self._set_ws_open(is_open)
+        if not is_open:
+            # `run_forever` reconnects and restores the subscriptions
+            self._wake_up()
+
     async def restart(self):
         await self.unsubscribe_issuers()
         # Give some time for the CLOSE events to propagate before restarting
@@ -181,7 +812,7 @@ class NostrClient:
         logger.info("Restating NostrClient...")
         await self.recieve_event_queue.put(ValueError("Restarting NostrClient..."))
 
-        self._safe_ws_stop()
+        await self._close_ws()
 
     async def stop(self):
         await self.unsubscribe_issuers()
@@ -189,14 +820,23 @@ class NostrClient:
 
         # Give some time for the CLOSE events to propagate before closing the connection
         await asyncio.sleep(10)
-        self._safe_ws_stop()
+        for temp_subscription in self.temp_subscriptions.values():
+            temp_subscription.done()
+        self.temp_subscriptions = {}
+        if self._temp_timer:
+            self._temp_timer.cancel()
+            self._temp_timer = None
+
+        # let `run_forever` exit and close the connection
+        self._wake_up()
 
     async def unsubscribe_issuers(self):
-        await self.send_req_queue.put(["CLOSE", self.subscription_id])
-        logger.debug(
-            f"Unsubscribed from all issuers events. Subscription id: {self.subscription_id}"
-        )
+        shards, self.shards = self.shards, []
+        self._issuer_shards = {}
+        for shard in shards:
+            await self.close_shard(shard)
+        logger.debug(f"Unsubscribed from all issuers events ({len(shards)} shards).")
 
     async def unsubscribe(self, subscription_id):
-        await self.send_req_queue.put(["CLOSE", subscription_id])
+        await self._queue_req(["CLOSE", subscription_id])
         logger.debug(f"Unsubscribed from subscription id: {subscription_id}")
@@ -0,0 +1,63 @@
+import asyncio
+import time
+from collections import deque
+from typing import List, Optional
+
+
+class PublishAck:
+    """
+    Tracks the relay `OK` messages for one published event.
+    """
+
+    def __init__(self, event_id: str, wait_for_ok: int = 0):
+        self.event_id = event_id
+        self.wait_for_ok = wait_for_ok
+        self.started_at = time.monotonic()
+        self.accepted = 0
+        self.rejections: List[str] = []
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def on_ok(self, accepted: bool, message: str) -> Optional[float]:
+        """
+        Returns the round trip time in seconds for the first `OK`.
+        """
+        first = self.accepted == 0 and len(self.rejections) == 0
+        if accepted:
+            self.accepted += 1
+        else:
+            self.rejections.append(message)
+
+        if self.accepted >= max(self.wait_for_ok, 1) and not self.future.done():
+            self.future.set_result(True)
+
+        return time.monotonic() - self.started_at if first else None
+
+
+class LatencyStats:
+    """
+    Keeps the last `size` latency samples, in seconds.
+    """
+
+    def __init__(self, size: int = 1_000):
+        self.samples: deque = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def stats(self) -> dict:
+        if not self.samples:
+            return {"count": self.count}
+        ordered = sorted(self.samples)
+
+        def percentile(p: float) -> float:
+            return round(ordered[int(p * (len(ordered) - 1))] * 1000, 2)
+
+        return {
+            "count": self.count,
+            "avg_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+            "p50_ms": percentile(0.5),
+            "p95_ms": percentile(0.95),
+            "max_ms": round(ordered[-1] * 1000, 2),
+        }
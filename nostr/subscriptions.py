@@ -0,0 +1,150 @@
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+from lnbits.helpers import urlsafe_short_hash
+
+
+class IssuerShard:
+    """
+    A subscription for a slice of the issuers public keys.
+    Every shard has its own subscription id and `since` cursors, so it can be
+    opened and closed without touching the other shards.
+    """
+
+    def __init__(
+        self,
+        public_keys: List[str],
+        badge_time=0,
+        award_time=0,
+        dm_time=0,
+    ):
+        self.public_keys = public_keys
+        # keys added after the shard was created, they have no cursor yet
+        self.new_public_keys: List[str] = []
+        self.badge_time = badge_time
+        self.award_time = award_time
+        self.dm_time = dm_time
+        self.subscription_id = "poap-" + urlsafe_short_hash()[:32]
+        self.is_open = False
+        # EOSE was received, the relays are now sending new events only
+        self.is_live = False
+        self.req_time = 0
+        # consecutive retries (CLOSED replies or dropped events), for the backoff
+        self.retries = 0
+        # backfill events dropped since the REQ, see `NostrClient.overflow_policy`
+        self.dropped_events = 0
+        # false while fetching again after dropped events, the retry must finish
+        self.can_drop_events = True
+
+    @classmethod
+    def from_cursors(
+        cls, public_keys: List[str], cursors: Dict[str, Dict[int, int]]
+    ) -> "IssuerShard":
+        """
+        The shard starts from the oldest cursor of its issuers for every kind.
+        Issuers without cursors are fetched from the start.
+        """
+        synced = [pk for pk in public_keys if pk in cursors]
+
+        def since(kind: int) -> int:
+            oldest = min(cursors[pk].get(kind, 0) for pk in synced) if synced else 0
+            # relays apply `since` to live events too, never start in the future
+            return min(oldest, round(time.time()))
+
+        shard = cls(synced, since(30009), since(8), since(4))
+        shard.new_public_keys = [pk for pk in public_keys if pk not in cursors]
+        return shard
+
+    @property
+    def size(self) -> int:
+        return len(self.public_keys) + len(self.new_public_keys)
+
+    def add_public_key(self, public_key: str):
+        self.new_public_keys.append(public_key)
+
+    def remove_public_key(self, public_key: str):
+        if public_key in self.public_keys:
+            self.public_keys.remove(public_key)
+        if public_key in self.new_public_keys:
+            self.new_public_keys.remove(public_key)
+
+    def renew_subscription_id(self):
+        self.subscription_id = "poap-" + urlsafe_short_hash()[:32]
+
+    def mark_open(self):
+        self.is_open = True
+        self.is_live = False
+        self.req_time = round(time.time())
+        self.dropped_events = 0
+
+    def mark_closed(self):
+        self.is_open = False
+        self.is_live = False
+
+    def on_eose(self):
+        # relays have sent every stored event up to the REQ time
+        if not self.req_time:
+            return
+        self.is_live = True
+        self.retries = 0
+        self.can_drop_events = True
+        self.public_keys += self.new_public_keys
+        self.new_public_keys = []
+        cursor = self.req_time - 1
+        self.badge_time = max(self.badge_time, cursor)
+        self.award_time = max(self.award_time, cursor)
+        self.dm_time = max(self.dm_time, cursor)
+
+
+class ShardEose:
+    """
+    Queued with the events when a shard receives EOSE. The shard cursors move
+    once the events received before it have all been handled.
+    """
+
+    __slots__ = ("shard", "subscription_id", "req_time")
+
+    def __init__(self, shard: IssuerShard):
+        self.shard = shard
+        self.subscription_id = shard.subscription_id
+        self.req_time = shard.req_time
+
+    def is_current(self) -> bool:
+        # false if the shard was closed or re-opened since
+        shard = self.shard
+        return (
+            shard.is_open
+            and not shard.is_live
+            and shard.subscription_id == self.subscription_id
+            and shard.req_time == self.req_time
+        )
+
+
+class TempSubscription:
+    """
+    A short lived subscription that collects its events until EOSE or until
+    its deadline, whichever comes first.
+    """
+
+    def __init__(self, prefix: str, filters: List[dict], deadline: float, forward: bool):
+        self.subscription_id = f"{prefix}-" + urlsafe_short_hash()[:32]
+        self.filters = filters
+        self.deadline = deadline
+        # also hand the events over to the ingest queue
+        self.forward = forward
+        self.events: List[dict] = []
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    @staticmethod
+    def key_for(filters: List[dict], forward: bool) -> str:
+        return json.dumps([filters, forward], sort_keys=True)
+
+    @property
+    def key(self) -> str:
+        return self.key_for(self.filters, self.forward)
+
+    def done(self):
+        if not self.future.done():
+            self.future.set_result(self.events)
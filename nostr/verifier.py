@@ -0,0 +1,117 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from ..cache import LRUCache
+from ..helpers import run_crypto
+from .event import IngestEvent
+
+
+def verify_signatures(events: List[IngestEvent]) -> List[bool]:
+    # module level function so it can also run in a process pool
+    results = []
+    for event in events:
+        try:
+            event.check_signature()
+            results.append(True)
+        except Exception:
+            results.append(False)
+    return results
+
+
+class EventVerifier:
+    """
+    Verifies event signatures in batches on an executor, off the event loop.
+    Events are collected until `batch_size` is reached or `batch_delay`
+    seconds have passed. Ids that already passed are remembered, and copies
+    of an event being verified share its future.
+    The shared crypto executor is used unless `executor` is given.
+    """
+
+    def __init__(
+        self,
+        executor: Optional[Executor] = None,
+        batch_size: int = 64,
+        batch_delay: float = 0.01,
+        cache_size: int = 100_000,
+    ):
+        self.executor = executor
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.verified = LRUCache(max_size=cache_size)
+        self.invalid = 0
+        self._pending: List[Tuple[IngestEvent, asyncio.Future]] = []
+        # futures of the events queued or being verified, by id and signature
+        self._in_flight: Dict[Tuple[str, Optional[str]], asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def submit(self, event: IngestEvent) -> asyncio.Future:
+        """
+        Queue the event for verification.
+        The returned future resolves to `True` if the signature is valid.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # the id is set by the relay, only a matching content hash can skip
+        # the signature check
+        if event.id == event.event_id:
+            if self.verified.get(event.id):
+                future.set_result(True)
+                return future
+            # same content and signature: valid only if the first copy is
+            key = (event.id, event.sig)
+            in_flight = self._in_flight.get(key)
+            if in_flight:
+                return in_flight
+            self._in_flight[key] = future
+
+        self._pending.append((event, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif not self._flush_handle:
+            self._flush_handle = loop.call_later(self.batch_delay, self._flush)
+        return future
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.create_task(self._verify_batch(batch))
+
+    async def _verify_batch(self, batch: List[Tuple[IngestEvent, asyncio.Future]]):
+        events = [event for event, _ in batch]
+        try:
+            if self.executor:
+                loop = asyncio.get_running_loop()
+                results = await loop.run_in_executor(
+                    self.executor, verify_signatures, events
+                )
+            else:
+                results = await run_crypto(verify_signatures, events)
+        except Exception as ex:
+            logger.warning(f"Signature verification failed: {ex}")
+            results = [False] * len(batch)
+
+        for (event, future), valid in zip(batch, results):
+            key = (event.id, event.sig)
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            if valid:
+                self.verified.put(event.id, True)
+            else:
+                self.invalid += 1
+                logger.debug(f"Invalid signature for event '{event.id}'")
+            if not future.done():
+                future.set_result(valid)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "in_flight": len(self._in_flight),
+            "invalid": self.invalid,
+            "verified_cache": self.verified.stats(),
+        }
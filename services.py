@@ -1,34 +1,228 @@
 import asyncio
+import csv
+import io
 import json
+import time
+import uuid
+import zlib
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
 
 from loguru import logger
 
-from . import nostr_client
+from . import db, nostr_client
+from .cache import LRUCache
 from .crud import (
-    check_awarded_to_pubkey,
-    create_award_poap,
-    create_poap,
-    get_awards,
+    bulk_create_awards,
+    bulk_create_poaps,
+    claim_award,
     get_issuer_by_pubkey,
     get_issuers_ids_with_pubkeys,
-    get_last_award_update_time,
-    get_last_poap_update_time,
     get_poap,
     get_poaps,
-    update_award,
+    get_sync_cursors,
+    unclaim_award,
     update_poap,
+    upsert_sync_cursors,
 )
 from .geohash.distances import geohash_approximate_distance, geohash_haversine_distance
 from .geohash.geohash import gh_encode
-from .models import POAP, CreateAward, Issuer, Nostrable
-from .nostr.event import NostrEvent
+from .models import POAP, Award, CreateAward, Issuer, Nostrable
+from .nostr.event import IngestEvent, NostrEvent
+from .nostr.message import classify_message, json_loads
+from .nostr.subscriptions import IssuerShard
+
+# ids of the events already handled, shared by all relays
+seen_events = LRUCache(max_size=100_000, ttl=60 * 60)
+# ids of the events parsed but not handled yet, with the frames of the copies
+# received meanwhile. The copies are parsed only if the first one is invalid.
+pending_events = LRUCache(max_size=50_000, ttl=10 * 60)
+MAX_SPARE_COPIES = 3
+
+# last seen `created_at` by issuer public key and kind, see `poap.sync_state`
+sync_cursors: Dict[str, Dict[int, int]] = {}
+_dirty_sync_cursors: Set[Tuple[str, int]] = set()
+
+
+class IngestWriter:
+    """
+    Write-behind buffer for the badges and awards read from the relays.
+    Buffered rows are written in a single transaction once `max_size` rows
+    are waiting or `max_delay` seconds after the first one was added.
+    A batch that fails is written again one row at a time: the rows that
+    still fail while others succeed are dropped. If none succeed the rows
+    are retried later, at most `max_attempts` times, and the handlers wait
+    while `max_buffered` rows are waiting.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 200,
+        max_delay: float = 1.0,
+        max_buffered: int = 10_000,
+        max_attempts: int = 5,
+    ):
+        assert max_size > 0, "The batch size must be positive"
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+        self.max_attempts = max_attempts
+        self.poaps: Dict[str, POAP] = {}
+        self.awards: Dict[str, CreateAward] = {}
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.dropped = 0
+        # failed attempts of the rows waiting for a retry
+        self._attempts: Dict[Tuple[str, str], int] = {}
+        # the last flush failed, the next one runs on the retry timer
+        self._retrying = False
+        self._room = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def add_poap(self, poap: POAP):
+        self._keep_newest(self.poaps, poap)
+        await self._added()
+
+    async def add_award(self, award: CreateAward):
+        self._keep_newest(self.awards, award)
+        await self._added()
+
+    @staticmethod
+    def _keep_newest(rows: Dict, row):
+        # relays backfill newest first, a replaceable badge can come twice
+        current = rows.get(row.id)
+        if not current or (row.event_created_at or 0) > (
+            current.event_created_at or 0
+        ):
+            rows[row.id] = row
+
+    async def _added(self):
+        if self._retrying:
+            # do not run a failing transaction for every row added
+            while self._retrying and len(self) >= self.max_buffered:
+                self._room.clear()
+                await self._room.wait()
+            return
+        if len(self) >= self.max_size:
+            await self.flush()
+        elif not self._flush_handle:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        loop = asyncio.get_running_loop()
+        self._flush_handle = loop.call_later(self.max_delay, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> bool:
+        """
+        Returns `False` if rows could not be written. They stay buffered and
+        are retried with the next flush.
+        """
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        async with self._lock:
+            poaps, self.poaps = list(self.poaps.values()), {}
+            awards, self.awards = list(self.awards.values()), {}
+            try:
+                if poaps or awards:
+                    await self._write(poaps, awards)
+                    self.written += len(poaps) + len(awards)
+                    self.batches += 1
+                    self._attempts.clear()
+                self._retrying = False
+            except Exception as ex:
+                logger.warning(
+                    f"Failed to store {len(poaps)} badges and {len(awards)} awards, retrying one by one: {ex}"
+                )
+                self._retrying = not await self._write_one_by_one(poaps, awards)
+                if self._retrying and not self._flush_handle:
+                    self._schedule_flush()
+            finally:
+                self._room.set()
+            return not self._retrying
+
+    async def _write(self, poaps: List[POAP], awards: List[CreateAward]):
+        async with db.connect() as conn:
+            await bulk_create_poaps(poaps, conn)
+            await bulk_create_awards(awards, conn)
+
+    async def _write_one_by_one(
+        self, poaps: List[POAP], awards: List[CreateAward]
+    ) -> bool:
+        """
+        Returns `False` if no row could be written, the rows are buffered
+        again unless they already failed `max_attempts` times.
+        """
+        failed = []
+        written = 0
+        rows = [("badge", poap) for poap in poaps] + [
+            ("award", award) for award in awards
+        ]
+        for kind, row in rows:
+            try:
+                if kind == "badge":
+                    await self._write([row], [])
+                else:
+                    await self._write([], [row])
+                written += 1
+                self._attempts.pop((kind, row.id), None)
+            except Exception as ex:
+                failed.append((kind, row, ex))
+        self.written += written
+        self.failed += len(failed)
+
+        retried = False
+        for kind, row, ex in failed:
+            attempts = self._attempts.pop((kind, row.id), 0) + 1
+            # the others were written, this row would never be
+            if written or attempts >= self.max_attempts:
+                self.dropped += 1
+                logger.warning(f"Dropping {kind} '{row.id}' that cannot be stored: {ex}")
+                continue
+            self._attempts[(kind, row.id)] = attempts
+            self._keep_newest(self.poaps if kind == "badge" else self.awards, row)
+            retried = True
+        return not retried
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self),
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+    def __len__(self) -> int:
+        return len(self.poaps) + len(self.awards)
+
+
+ingest_writer = IngestWriter()
+
+
+def ingest_stats() -> dict:
+    return {
+        "dedup": seen_events.stats(),
+        "pending": pending_events.stats(),
+        "writer": ingest_writer.stats(),
+    }
 
 
 async def update_issuer_to_nostr(issuer: Issuer, delete_issuer=False) -> Issuer:
     # update poaps
     poaps = await get_poaps(issuer.id)
-    for poap in poaps:
-        event = await sign_and_send_to_nostr(issuer, poap)
+    events = [poap.to_nostr_event(issuer.public_key) for poap in poaps]
+    signatures = await issuer.sign_hashes_async([bytes.fromhex(e.id) for e in events])
+    for poap, event, sig in zip(poaps, events, signatures):
+        event.sig = sig
+        await nostr_client.publish_nostr_event(event)
         poap.event_id = event.id
         poap.event_created_at = event.created_at
         await update_poap(issuer.id, poap)
@@ -41,61 +235,264 @@ async def update_issuer_to_nostr(issuer: Issuer, delete_issuer=False) -> Issuer:
 
 
 async def sign_and_send_to_nostr(
-    issuer: Issuer, n: Nostrable, delete=False
+    issuer: Issuer, n: Nostrable, delete=False, wait_for_ok=0
 ) -> NostrEvent:
+    """
+    With `wait_for_ok` set, raises `ValueError` unless enough relays accepted
+    the event in time.
+    """
+    event = await sign_nostr_event(issuer, n, delete)
+    published = await nostr_client.publish_nostr_event(
+        event, wait_for_ok=wait_for_ok
+    )
+    if not published:
+        raise ValueError("Event not confirmed by the relays. Please try again.")
+
+    return event
+
+
+async def sign_nostr_event(issuer: Issuer, n: Nostrable, delete=False) -> NostrEvent:
     event = (
         n.to_nostr_delete_event(issuer.public_key)
         if delete
         else n.to_nostr_event(issuer.public_key)
     )
-    event.sig = issuer.sign_hash(bytes.fromhex(event.id))
-    await nostr_client.publish_nostr_event(event)
-
+    event.sig = await issuer.sign_hash_async(bytes.fromhex(event.id))
     return event
 
 
-async def resubscribe_to_all_issuers():
-    await nostr_client.unsubscribe_issuers()
-    # give some time for the message to propagate
-    await asyncio.sleep(1)
-    await subscribe_to_all_issuers()
+async def award_poap(
+    issuer: Issuer, badge: POAP, claim_pubkey: str, wait_for_ok=0
+) -> Award:
+    """
+    Award the badge to the public key, at most once.
+    The event is signed first so the award row is stored, event id included,
+    with a single insert. It is published only if the insert succeeded.
+    The award is removed again only if the relays rejected the event: when
+    they did not answer in time it may still be stored, and awarding the
+    badge again would publish a second award.
+    """
+    award = Award(
+        id=uuid.uuid4().hex,
+        badge_id=badge.id,
+        issuer=issuer.id,
+        claim_pubkey=claim_pubkey,
+    )
+    event = await sign_nostr_event(issuer, award)
+    award.event_id = event.id
+    award.event_created_at = event.created_at
+
+    claimed = await claim_award(award)
+    assert claimed, "POAP was already awarded to this pubkey."
+
+    try:
+        published = await nostr_client.publish_nostr_event(
+            event, wait_for_ok=wait_for_ok
+        )
+    except ValueError:
+        # rejected, the badge can be claimed again
+        await unclaim_award(claimed)
+        raise
+    if not published:
+        logger.warning(
+            f"Award '{claimed.id}' not confirmed by the relays yet, it is kept"
+        )
+    return claimed
+
+
+AWARD_EXPORT_COLUMNS = [
+    "id",
+    "badge_id",
+    "issuer",
+    "claim_pubkey",
+    "event_id",
+    "event_created_at",
+]
+
+
+async def export_awards(
+    awards: AsyncIterator[Award], format="ndjson", compress=False, chunk_size=64 * 1024
+) -> AsyncIterator[bytes]:
+    """
+    Encode the awards as NDJSON or CSV lines, optionally gzip compressed.
+    Output is yielded in chunks of about `chunk_size` bytes as the awards are
+    read, so memory use does not grow with the number of awards.
+    """
+    assert format in ("ndjson", "csv"), f"Unknown export format '{format}'"
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if format == "csv" else None
+    # wbits 31 writes the gzip header and trailer
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def _encode(text: str) -> bytes:
+        data = text.encode()
+        return compressor.compress(data) if compressor else data
+
+    if writer:
+        writer.writerow(AWARD_EXPORT_COLUMNS)
+    async for award in awards:
+        if writer:
+            writer.writerow([getattr(award, c) for c in AWARD_EXPORT_COLUMNS])
+        else:
+            row = {c: getattr(award, c) for c in AWARD_EXPORT_COLUMNS}
+            buffer.write(json.dumps(row))
+            buffer.write("\n")
+        if buffer.tell() >= chunk_size:
+            chunk = _encode(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+            if chunk:
+                yield chunk
+
+    tail = _encode(buffer.getvalue())
+    if compressor:
+        tail += compressor.flush()
+    if tail:
+        yield tail
 
 
 async def subscribe_to_all_issuers():
     ids = await get_issuers_ids_with_pubkeys()
     public_keys = [pk for _, pk in ids]
 
-    last_poap_time = await get_last_poap_update_time()
-    last_award_time = await get_last_award_update_time()
-    last_dm_time = last_award_time
+    await flush_sync_cursors()
+    sync_cursors.clear()
+    sync_cursors.update(await get_sync_cursors())
 
-    logger.debug(f"Timestamps: {last_poap_time}, {last_award_time}")
+    nostr_client.on_eose = _on_shard_eose
+    await nostr_client.subscribe_issuers(public_keys, sync_cursors)
 
-    await nostr_client.subscribe_issuers(
-        public_keys, last_poap_time, last_award_time, last_dm_time
-    )
+
+def advance_sync_cursor(public_key: str, kind: int, created_at: int):
+    cursors = sync_cursors.setdefault(public_key, {})
+    if created_at > cursors.get(kind, 0):
+        cursors[kind] = created_at
+        _dirty_sync_cursors.add((public_key, kind))
 
 
-async def process_nostr_message(msg: str):
+def forget_sync_cursors(public_key: str):
+    sync_cursors.pop(public_key, None)
+    for key in [k for k in _dirty_sync_cursors if k[0] == public_key]:
+        _dirty_sync_cursors.discard(key)
+
+
+async def flush_sync_cursors():
+    # never store a cursor ahead of the rows it covers
+    if not await ingest_writer.flush():
+        return
+    dirty = list(_dirty_sync_cursors)
+    _dirty_sync_cursors.clear()
+    cursors = []
+    for public_key, kind in dirty:
+        created_at = sync_cursors.get(public_key, {}).get(kind)
+        if created_at:
+            cursors.append((public_key, kind, created_at))
+    if not cursors:
+        return
     try:
-        type, *rest = json.loads(msg)
-
-        if type.upper() == "EVENT":
-            _, event = rest
-            event = NostrEvent(**event)
-            if event.kind == 4:
-                await _handle_nip04_message(event)
-            elif event.kind == 30009:
-                await _handle_badge(event)
-            elif event.kind == 8:
-                await _handle_award(event)
-            return
+        await upsert_sync_cursors(cursors)
+    except Exception:
+        _dirty_sync_cursors.update(dirty)
+        raise
+
+
+async def _on_shard_eose(shard: IssuerShard):
+    # called once the events received before EOSE have been handled
+    for public_key in shard.public_keys:
+        advance_sync_cursor(public_key, 30009, shard.badge_time)
+        advance_sync_cursor(public_key, 8, shard.award_time)
+        advance_sync_cursor(public_key, 4, shard.dm_time)
+    await flush_sync_cursors()
+
+
+def parse_nostr_message(msg: str) -> Optional[IngestEvent]:
+    try:
+        # cheap classification first, most frames are not handled at all
+        type, _, kind, event_id = classify_message(msg)
+        if type != "EVENT" or kind not in (4, 8, 30009):
+            return None
+        # the same event is delivered once by every connected relay.
+        # Only a copy that passed verification marks the id as seen, see
+        # `mark_event_seen`, an invalid first copy must not hide the others.
+        if event_id and seen_events.get(event_id):
+            return None
+        copies = pending_events.get(event_id) if event_id else None
+        if copies is not None:
+            if len(copies) < MAX_SPARE_COPIES:
+                copies.append(msg)
+            return None
+
+        _, _, event = json_loads(msg)
+        ingest_event = IngestEvent.from_dict(event)
+        pending_events.put(ingest_event.id, [])
+        return ingest_event
+
+    except Exception as ex:
+        logger.debug(ex)
+        return None
+
+
+def take_spare_copies(event: IngestEvent) -> List[IngestEvent]:
+    """
+    The copies of the event received while it was pending, for when it
+    turned out to be invalid.
+    """
+    copies = pending_events.get(event.id) or []
+    pending_events.pop(event.id)
+    events = []
+    for msg in copies:
+        try:
+            _, _, data = json_loads(msg)
+            events.append(IngestEvent.from_dict(data))
+        except Exception as ex:
+            logger.debug(ex)
+    return events
+
+
+def forget_pending_event(event: IngestEvent):
+    pending_events.pop(event.id)
+
+
+def mark_event_seen(event: IngestEvent) -> bool:
+    """
+    Returns `False` if a copy of the event was already handled.
+    """
+    return seen_events.add_if_absent(event.id)
+
+
+def event_ordering_key(event: IngestEvent) -> str:
+    """
+    Events that share this key must be handled in order.
+    It is the public key of the issuer the event belongs to.
+    """
+    if event.kind == 4:
+        p_tags = event.tag_values("p")
+        return p_tags[0] if len(p_tags) else event.pubkey
+    return event.pubkey
+
+
+async def handle_nostr_event(event: IngestEvent):
+    try:
+        if event.kind == 4:
+            await _handle_nip04_message(event)
+        elif event.kind == 30009:
+            await _handle_badge(event)
+        elif event.kind == 8:
+            await _handle_award(event)
+
+        # during a backfill events come newest first, only move live cursors.
+        # Direct messages are dated by their sender: a date in the future
+        # would hide the next claims, their cursor only moves on EOSE.
+        issuer_public_key = event_ordering_key(event)
+        if event.kind != 4 and nostr_client.is_issuer_live(issuer_public_key):
+            created_at = min(event.created_at, int(time.time()))
+            advance_sync_cursor(issuer_public_key, event.kind, created_at)
 
     except Exception as ex:
         logger.debug(ex)
 
 
-async def _handle_nip04_message(event: NostrEvent):
+async def _handle_nip04_message(event: IngestEvent):
     p_tags = event.tag_values("p")
     issuer_public_key = p_tags[0] if len(p_tags) else None
     issuer = (
@@ -106,22 +503,22 @@ async def _handle_nip04_message(event: NostrEvent):
     logger.debug(f"Handling NIP04 event: '{event.id}'")
 
     if issuer_public_key and event.has_tag_value("p", issuer_public_key):
-        clear_text_msg = issuer.decrypt_message(event.content, event.pubkey)
+        clear_text_msg = await issuer.decrypt_message_async(
+            event.content, event.pubkey
+        )
         logger.debug(f"Clear text message: {clear_text_msg}")
         await _handle_incoming_dms(event, issuer, clear_text_msg)
     else:
         logger.warning(f"Bad NIP04 event: '{event.id}'")
 
 
-async def _handle_incoming_dms(event: NostrEvent, issuer: Issuer, clear_text_msg: str):
+async def _handle_incoming_dms(event: IngestEvent, issuer: Issuer, clear_text_msg: str):
     try:
         json_data = json.loads(clear_text_msg)
         if json_data and json_data["type"] == "claim_poap":
             logger.debug(f"Data: {json_data}")
             badge = await get_poap(json_data["badge_id"])
             assert badge, f"POAP not found!"
-            not_yet_awarded = await check_awarded_to_pubkey(badge.id, event.pubkey)
-            assert not_yet_awarded, "POAP was already awarded to the pubkey."
             logger.debug(
                 f"Creating award for badge {badge.id} and pubkey {event.pubkey}"
             )
@@ -137,21 +534,7 @@ async def _handle_incoming_dms(event: NostrEvent, issuer: Issuer, clear_text_msg
                 distance = geohash_haversine_distance(geohash, badge.geohash) / 1000
                 assert distance < 50, "Seems that you are not in the right place."
 
-            create_award = CreateAward(
-                badge_id=badge.id,
-                issuer=issuer.id,
-                claim_pubkey=event.pubkey,
-            )
-            award = await create_award_poap(issuer.id, create_award)
-            assert award, "Award couldn't be created"
-
-            event = await sign_and_send_to_nostr(issuer, award)
-            assert event, "Award couldn't be uploaded to Nostr"
-
-            award.event_id = event.id
-            award.event_created_at = event.created_at
-
-            await update_award(award_id=award.id, data=award)
+            await award_poap(issuer, badge, event.pubkey)
         else:
             logger.debug(f"Message: {clear_text_msg}")
             return
@@ -160,7 +543,7 @@ async def _handle_incoming_dms(event: NostrEvent, issuer: Issuer, clear_text_msg
         logger.error(ex)
 
 
-async def _handle_badge(event: NostrEvent):
+async def _handle_badge(event: IngestEvent):
     try:
         issuer = await get_issuer_by_pubkey(event.pubkey)
         assert issuer, f"Issuer not found for public key '{event.pubkey}'"
@@ -183,13 +566,13 @@ async def _handle_badge(event: NostrEvent):
             event_id=event.id,
             event_created_at=event.created_at,
         )
-        await create_poap(issuer.id, poap)
+        await ingest_writer.add_poap(poap)
 
     except Exception as ex:
         logger.error(ex)
 
 
-async def _handle_award(event: NostrEvent):
+async def _handle_award(event: IngestEvent):
     try:
         issuer = await get_issuer_by_pubkey(event.pubkey)
         assert issuer, f"Issuer not found for public key '{event.pubkey}'"
@@ -201,14 +584,14 @@ async def _handle_award(event: NostrEvent):
         assert claim_pubkey[0], f"'p' tag not found on event"
 
         award = CreateAward(
-            id=event.content,
+            id=event.content or uuid.uuid4().hex,
             badge_id=badge[0].split(":")[1],
             issuer=issuer.id,
             claim_pubkey=claim_pubkey[0],
             event_id=event.id,
             event_created_at=event.created_at,
         )
-        await create_award_poap(issuer.id, award)
+        await ingest_writer.add_award(award)
 
     except Exception as ex:
         logger.error(ex)
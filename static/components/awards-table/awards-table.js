@@ -11,7 +11,7 @@ async function awardsTable(path) {
 
   Vue.component('awards-table', {
     name: 'awards-table',
-    props: ['awarded'],
+    props: ['awarded', 'hasMore'],
     template,
 
     data: function () {
@@ -44,6 +44,15 @@ async function awardsTable(path) {
       }
     },
     computed: {},
+    watch: {
+      // awards are loaded one page at a time, newest first
+      awarded: {
+        immediate: true,
+        handler(awarded) {
+          this.awards = awarded.map(mapAwards)
+        }
+      }
+    },
     methods: {
       getSelectedString() {
         return this.selected.length === 0
@@ -59,15 +68,13 @@ async function awardsTable(path) {
         this.$emit('copy-text', value)
       },
       exportCSV: function () {
-        const data = this.selected.length === 0 ? this.awards : this.selected
-        LNbits.utils.exportCSV(this.columns, data)
+        // only some pages are loaded, all the awards are exported by the API
+        if (this.selected.length === 0) {
+          this.$emit('export-csv')
+          return
+        }
+        LNbits.utils.exportCSV(this.columns, this.selected)
       }
-    },
-    created() {
-      this.awards = this.awarded.map(mapAwards).sort((a, b) => {
-        return b.event_created_at - a.event_created_at
-      })
-      console.log(this.awards)
     }
   })
 }
@@ -17,6 +17,9 @@ const issuer = async () => {
         issuer: {},
         poaps: [],
         awards: [],
+        // cursors of the next pages, null once the last page is loaded
+        poapsCursor: null,
+        awardsCursor: null,
         poapsTable: {
           columns: [
             {name: 'id', align: 'left', label: 'ID', field: 'id'},
@@ -133,14 +136,24 @@ const issuer = async () => {
         this.formDialog.show = false
         this.formDialog.data = {}
       },
-      async getPoaps() {
+      async getPage(path, cursor) {
+        const query = cursor ? `&cursor=${encodeURIComponent(cursor)}` : ''
+        const {data, headers} = await LNbits.api.request(
+          'GET',
+          `${path}?limit=100${query}`,
+          this.g.user.wallets[0].inkey
+        )
+        return {data, next: headers['x-next-cursor'] || null}
+      },
+      async getPoaps(more = false) {
         try {
-          const {data} = await LNbits.api.request(
-            'GET',
+          const {data, next} = await this.getPage(
             '/poap/api/v1/poaps',
-            this.g.user.wallets[0].inkey
+            more ? this.poapsCursor : null
           )
-          this.poaps = [...data].map(mapPoaps)
+          const poaps = data.map(mapPoaps)
+          this.poaps = more ? [...this.poaps, ...poaps] : poaps
+          this.poapsCursor = next
         } catch (error) {
           LNbits.utils.notifyApiError(error)
         }
@@ -181,7 +194,13 @@ const issuer = async () => {
           LNbits.utils.notifyApiError(error)
         }
       },
-      exportCSV: function () {
+      exportCSV: async function () {
+        // load the remaining pages first, stop if one fails
+        while (this.poapsCursor) {
+          const cursor = this.poapsCursor
+          await this.getPoaps(true)
+          if (this.poapsCursor === cursor) return
+        }
         LNbits.utils.exportCSV(this.poapsTable.columns, this.poaps)
       },
       openFormDialog(id) {
@@ -197,14 +216,26 @@ const issuer = async () => {
         this.urlDialog.show = true
       },
       // AWARDS / CLAIMS
-      async getAwards() {
+      async getAwards(more = false) {
+        try {
+          const {data, next} = await this.getPage(
+            '/poap/api/v1/awards',
+            more ? this.awardsCursor : null
+          )
+          this.awards = more ? [...this.awards, ...data] : data
+          this.awardsCursor = next
+        } catch (error) {
+          LNbits.utils.notifyApiError(error)
+        }
+      },
+      async exportAwardsCSV() {
         try {
           const {data} = await LNbits.api.request(
             'GET',
-            '/poap/api/v1/awards',
+            '/poap/api/v1/awards/export?format=csv',
             this.g.user.wallets[0].inkey
           )
-          this.awards = [...data]
+          Quasar.utils.exportFile('awards.csv', data, 'text/csv')
         } catch (error) {
           LNbits.utils.notifyApiError(error)
         }
@@ -1,17 +1,208 @@
 from .nostr.nostr_client import NostrClient
-from .services import process_nostr_message, subscribe_to_all_issuers
+from .nostr.event import IngestEvent
+from .nostr.subscriptions import ShardEose
+from .nostr.verifier import EventVerifier
+from .services import (
+    event_ordering_key,
+    flush_sync_cursors,
+    forget_pending_event,
+    handle_nostr_event,
+    mark_event_seen,
+    parse_nostr_message,
+    subscribe_to_all_issuers,
+    take_spare_copies,
+)
 from loguru import logger
+from collections import deque
+from functools import partial
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
 import asyncio
+import time
 
 
-async def wait_for_nostr_events(nostr_client: NostrClient):
+class EventWorkerPool:
+    """
+    Handles events concurrently on `size` workers.
+    Every ordering key (the issuer public key) has its own queue and at most
+    one worker on it, so its events are handled one after the other. Keys
+    take turns on the workers: a backfilling issuer does not hold back the
+    others. At most `max_pending` events wait in the pool.
+    Callbacks registered with `after` run once every event submitted before
+    them has been handled.
+    """
+
+    def __init__(self, size: int = 4, max_pending: int = 4_000):
+        assert size > 0, "The pool needs at least one worker"
+        self.size = size
+        self.max_pending = max_pending
+        # events by ordering key
+        self.pending: Dict[
+            str, Deque[Tuple[int, IngestEvent, Optional[asyncio.Future]]]
+        ] = {}
+        # keys with pending events and no worker on them, in turn order
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max_pending)
+        # submitted events are numbered, `after` callbacks wait for a number
+        self._next_seq = 0
+        self._in_flight: Set[int] = set()
+        self._barriers: Deque[Tuple[int, Callable[[], Awaitable]]] = deque()
+        self._barrier_tasks: Set[asyncio.Task] = set()
+        self.tasks: List[asyncio.Task] = []
+        self.handled = 0
+        self.created_at = time.monotonic()
+        # seconds from creation to the first handled event
+        self.first_event_after: Optional[float] = None
+
+    def start(self):
+        if self.tasks:
+            return
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.size)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def submit(
+        self, event: IngestEvent, verification: Optional[asyncio.Future] = None
+    ):
+        """
+        The optional `verification` future must resolve to `True` before the
+        event is handled, otherwise the event is dropped.
+        """
+        # first, it reads tags that are not validated yet and can raise
+        key = event_ordering_key(event)
+        # waits only while the whole pool is full, keeping the client queue as buffer
+        await self._slots.acquire()
+        seq = self._next_seq
+        self._next_seq += 1
+        self._in_flight.add(seq)
+        queue = self.pending.get(key)
+        if queue is None:
+            self.pending[key] = deque([(seq, event, verification)])
+            self.ready.put_nowait(key)
+        else:
+            queue.append((seq, event, verification))
+
+    def after(self, callback: Callable[[], Awaitable]):
+        """
+        Run `callback` once the events submitted so far have been handled.
+        """
+        self._barriers.append((self._next_seq, callback))
+        self._run_barriers()
+
+    def _run_barriers(self):
+        if not self._barriers:
+            return
+        oldest = min(self._in_flight, default=self._next_seq)
+        while self._barriers and self._barriers[0][0] <= oldest:
+            _, callback = self._barriers.popleft()
+            task = asyncio.create_task(self._run_barrier(callback))
+            self._barrier_tasks.add(task)
+            task.add_done_callback(self._barrier_tasks.discard)
+
+    async def _run_barrier(self, callback: Callable[[], Awaitable]):
+        try:
+            await callback()
+        except Exception as ex:
+            logger.warning(ex)
+
+    async def _work(self):
+        while True:
+            key = await self.ready.get()
+            queue = self.pending[key]
+            seq, event, verification = queue.popleft()
+            try:
+                if verification and not await verification:
+                    copy = await self._valid_copy(event)
+                    if not copy:
+                        continue
+                    event = copy
+                if not mark_event_seen(event):
+                    continue
+                await handle_nostr_event(event)
+                self.handled += 1
+                if self.first_event_after is None:
+                    self.first_event_after = time.monotonic() - self.created_at
+                    logger.info(
+                        f"First nostr event handled {self.first_event_after:.2f} seconds after start"
+                    )
+            except Exception as ex:
+                logger.warning(ex)
+            finally:
+                forget_pending_event(event)
+                self._slots.release()
+                self._in_flight.discard(seq)
+                self._run_barriers()
+                # back of the line, the other keys get their turn first
+                if queue:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.pending[key]
+
+    async def _valid_copy(self, event: IngestEvent) -> Optional[IngestEvent]:
+        # an invalid copy must not hide the valid ones received meanwhile
+        for copy in take_spare_copies(event):
+            if await event_verifier.submit(copy):
+                return copy
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.size,
+            "handled": self.handled,
+            "first_event_after": self.first_event_after,
+            "pending": sum(len(q) for q in self.pending.values()),
+            "pending_keys": len(self.pending),
+        }
+
+
+event_workers = EventWorkerPool()
+event_verifier = EventVerifier()
+
+
+async def flush_sync_cursors_forever(interval: int = 30):
     while True:
+        await asyncio.sleep(interval)
         try:
-            await subscribe_to_all_issuers()
-            while True:
-                message = await nostr_client.get_event()
-                print(f"### MSG: {message}")
-                await process_nostr_message(message)
-        except Exception as e:
-            logger.warning(f"Subcription failed. Will retry in one minute: {e}")
-            await asyncio.sleep(10)
+            await flush_sync_cursors()
+        except Exception as ex:
+            logger.warning(f"Failed to store sync cursors: {ex}")
+
+
+async def wait_for_nostr_events(nostr_client: NostrClient, verify_signatures=True):
+    event_workers.start()
+    try:
+        while True:
+            try:
+                # subscribe as soon as the 'nostrclient' websocket is open
+                await nostr_client.wait_until_connected()
+                await subscribe_to_all_issuers()
+                while True:
+                    message = await nostr_client.get_event()
+                    if isinstance(message, ShardEose):
+                        # cursors move once the events before EOSE are stored
+                        eose = partial(nostr_client.complete_shard_eose, message)
+                        event_workers.after(eose)
+                        continue
+                    event = parse_nostr_message(message)
+                    if not event:
+                        continue
+                    # verification runs in batches while the event waits in line
+                    verification = (
+                        event_verifier.submit(event) if verify_signatures else None
+                    )
+                    try:
+                        await event_workers.submit(event, verification)
+                    except Exception as ex:
+                        # a malformed event must not restart the subscriptions
+                        forget_pending_event(event)
+                        logger.debug(f"Dropping event '{event.id}': {ex}")
+            except Exception as e:
+                logger.warning(f"Subcription failed. Will retry in one minute: {e}")
+                await asyncio.sleep(10)
+    finally:
+        await event_workers.stop()
+        # store what is still buffered, and the cursors covering it
+        await flush_sync_cursors()
@@ -10,7 +10,7 @@ from lnbits.decorators import check_user_exists
 from lnbits.settings import settings
 
 from . import poap_ext, poap_renderer
-from .crud import get_poap, get_awards_poap
+from .crud import get_award_counter, get_poap
 
 poaps = Jinja2Templates(directory="poaps")
 
@@ -35,13 +35,13 @@ async def poap(request: Request, poap_id):
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Poap does not exist."
         )
-    awards = await get_awards_poap(poap.id)
+    counter = await get_award_counter("badge", poap.id)
     return poap_renderer().TemplateResponse(
         "poap/poap.html",
         {
             "request": request,
             "poap": poap.dict(),
-            "awards": [award.dict() for award in awards],
+            "awarded": counter.awards,
             "web_manifest": f"/poap/manifest/{poap_id}.webmanifest",
         },
     )
@@ -1,9 +1,10 @@
 from http import HTTPStatus
-from typing import Optional
+from typing import List, Optional, Tuple
 
-from fastapi import Depends, Request
+from fastapi import Depends, Query, Request, Response
 from loguru import logger
 from starlette.exceptions import HTTPException
+from starlette.responses import StreamingResponse
 
 from lnbits.decorators import (
     WalletTypeInfo,
@@ -19,26 +20,61 @@ from .crud import (
     get_issuer_for_user,
     create_poap,
     update_poap,
-    # delete_poap,
+    delete_poap,
     get_poap,
-    get_poaps,
-    create_award_poap,
-    update_award,
-    check_awarded_to_pubkey,
-    get_awards,
+    get_poaps_page,
+    get_awards_page,
+    stream_awards,
+    stream_awards_poap,
     delete_issuer_poaps,
     delete_issuer_awards,
     delete_issuer,
+    delete_sync_cursors,
+    get_award_counter,
+    get_badge_award_counters,
+    rebuild_award_counters,
 )
 from .models import CreateIssuer, Issuer, CreatePOAP, CreateAward
 from .services import (
+    award_poap,
+    export_awards,
+    forget_sync_cursors,
+    ingest_stats,
     sign_and_send_to_nostr,
-    resubscribe_to_all_issuers,
     update_issuer_to_nostr,
-    subscribe_to_all_issuers,
 )
 from . import nostr_client
-from .helpers import normalize_public_key
+from .helpers import (
+    decode_page_cursor,
+    encode_page_cursor,
+    forget_shared_secrets,
+    forget_signer,
+    normalize_public_key,
+)
+from .tasks import event_verifier, event_workers
+
+# listings are paginated, the next page cursor is sent in this header
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def _page_after(cursor: Optional[str]) -> Optional[Tuple[int, str]]:
+    if not cursor:
+        return None
+    try:
+        return decode_page_cursor(cursor)
+    except ValueError as ex:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(ex))
+
+
+def _set_next_cursor(response: Response, page: List, limit: int):
+    # a short page is the last one
+    if len(page) == limit:
+        last = page[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_page_cursor(
+            last.event_created_at, last.id
+        )
 
 
 @poap_ext.post("/api/v1/issuer")
@@ -57,9 +93,8 @@ async def api_create_issuer(
 
         issuer = await create_issuer(wallet.wallet.user, data)
 
-        await resubscribe_to_all_issuers()
-
-        await nostr_client.issuer_temp_subscription(issuer.public_key)
+        # the new public key is fetched from the start, no temp subscription needed
+        await nostr_client.add_issuer(issuer.public_key)
 
         return issuer
     except AssertionError as ex:
@@ -108,6 +143,12 @@ async def api_delete_issuer(
 
         await delete_issuer(issuer.id)
 
+        await nostr_client.remove_issuer(issuer.public_key)
+        forget_sync_cursors(issuer.public_key)
+        forget_signer(issuer.private_key)
+        forget_shared_secrets(issuer.public_key)
+        await delete_sync_cursors(issuer.public_key)
+
     except AssertionError as ex:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
@@ -119,8 +160,6 @@ async def api_delete_issuer(
             status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
             detail="Cannot get merchant",
         )
-    finally:
-        await subscribe_to_all_issuers()
 
 
 @poap_ext.put("/api/v1/issuer/{issuer_id}/nostr")
@@ -214,8 +253,13 @@ async def api_poap_create(
         poap = await create_poap(issuer_id=issuer.id, data=data)
         assert poap, "POAP couldn't be created"
 
-        event = await sign_and_send_to_nostr(issuer, poap)
-        assert event, "POAP couldn't be uploaded to Nostr"
+        try:
+            event = await sign_and_send_to_nostr(issuer, poap, wait_for_ok=1)
+        except Exception:
+            # a new badge that never reached the relays is not kept
+            if not data.id:
+                await delete_poap(issuer.id, poap.id)
+            raise
         logger.debug(f"POAP uploaded to Nostr: {event}")
 
         poap.event_id = event.id
@@ -276,6 +320,9 @@ async def api_poap_update(
 
 @poap_ext.get("/api/v1/poaps", status_code=HTTPStatus.OK)
 async def api_poaps(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     wallet: WalletTypeInfo = Depends(require_invoice_key),
 ):
     issuer = await get_issuer_for_user(wallet.wallet.user)
@@ -283,7 +330,9 @@ async def api_poaps(
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Issuer does not exist."
         )
-    return [poap.dict() for poap in await get_poaps(issuer.id)]
+    poaps = await get_poaps_page(issuer.id, limit, _page_after(cursor))
+    _set_next_cursor(response, poaps, limit)
+    return [poap.dict() for poap in poaps]
 
 
 ## Get a specific poap belonging to a user
@@ -320,30 +369,16 @@ async def api_poap_award(
         )
     data.claim_pubkey = normalize_public_key(data.claim_pubkey)
     try:
-        not_yet_awarded = await check_awarded_to_pubkey(
-            data.badge_id, data.claim_pubkey
-        )
-        assert not_yet_awarded, "POAP was already awarded to your pubkey."
-
         poap = await get_poap(data.badge_id)
         assert poap, "POAP couldn't be retrieved"
 
-        issuer = await get_issuer(data.issuer)
+        issuer = await get_issuer(poap.issuer_id)
         if not issuer:
             raise HTTPException(
                 status_code=HTTPStatus.NOT_FOUND, detail="Issuer does not exist."
             )
 
-        award = await create_award_poap(issuer.id, data)
-        assert award, "Award couldn't be created"
-
-        event = await sign_and_send_to_nostr(issuer, award)
-        assert event, "Award couldn't be uploaded to Nostr"
-
-        award.event_id = event.id
-        award.event_created_at = event.created_at
-
-        await update_award(award_id=award.id, data=award)
+        await award_poap(issuer, poap, data.claim_pubkey, wait_for_ok=1)
         return
 
     except (ValueError, AssertionError) as ex:
@@ -361,6 +396,69 @@ async def api_poap_award(
 
 @poap_ext.get("/api/v1/awards", status_code=HTTPStatus.OK)
 async def api_awards(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    wallet: WalletTypeInfo = Depends(require_invoice_key),
+):
+    issuer = await get_issuer_for_user(wallet.wallet.user)
+    if not issuer:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Issuer does not exist."
+        )
+    awards = await get_awards_page(issuer.id, limit, _page_after(cursor))
+    _set_next_cursor(response, awards, limit)
+    return [award.dict() for award in awards]
+
+
+@poap_ext.get("/api/v1/awards/export", status_code=HTTPStatus.OK)
+async def api_awards_export(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    badge_id: Optional[str] = None,
+    gzip: bool = False,
+    wallet: WalletTypeInfo = Depends(require_invoice_key),
+):
+    issuer = await get_issuer_for_user(wallet.wallet.user)
+    if not issuer:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Issuer does not exist."
+        )
+    if badge_id:
+        poap = await get_poap(badge_id)
+        if not poap or poap.issuer_id != issuer.id:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND, detail="POAP does not exist."
+            )
+        awards = stream_awards_poap(poap.id)
+        filename = f"awards-{poap.id}.{format}"
+    else:
+        awards = stream_awards(issuer.id)
+        filename = f"awards-{issuer.id}.{format}"
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    if gzip:
+        media_type = "application/gzip"
+        filename += ".gz"
+    return StreamingResponse(
+        export_awards(awards, format, compress=gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+## Award counters
+
+
+async def _award_stats(issuer_id: str) -> dict:
+    issuer_counter = await get_award_counter("issuer", issuer_id)
+    return {
+        **issuer_counter.dict(),
+        "badges": [c.dict() for c in await get_badge_award_counters(issuer_id)],
+    }
+
+
+@poap_ext.get("/api/v1/stats", status_code=HTTPStatus.OK)
+async def api_award_stats(
     wallet: WalletTypeInfo = Depends(require_invoice_key),
 ):
     issuer = await get_issuer_for_user(wallet.wallet.user)
@@ -368,4 +466,41 @@ async def api_awards(
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Issuer does not exist."
         )
-    return [award.dict() for award in await get_awards(issuer.id)]
+    return await _award_stats(issuer.id)
+
+
+@poap_ext.put("/api/v1/stats", status_code=HTTPStatus.OK)
+async def api_rebuild_award_stats(
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+):
+    issuer = await get_issuer_for_user(wallet.wallet.user)
+    if not issuer:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Issuer does not exist."
+        )
+    before = await get_award_counter("issuer", issuer.id)
+    await rebuild_award_counters(issuer.id)
+    stats = await _award_stats(issuer.id)
+    if before.awards != stats["awards"]:
+        logger.warning(
+            f"Award counter for issuer '{issuer.id}' was {before.awards}, recounted {stats['awards']}"
+        )
+    return stats
+
+
+@poap_ext.get("/api/v1/poaps/{poap_id}/stats", status_code=HTTPStatus.OK)
+async def api_poap_stats(poap_id: str):
+    counter = await get_award_counter("badge", poap_id)
+    return counter.dict()
+
+
+@poap_ext.get("/api/v1/metrics", status_code=HTTPStatus.OK)
+async def api_metrics(
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+):
+    return {
+        "nostr_client": nostr_client.stats(),
+        "ingest": ingest_stats(),
+        "workers": event_workers.stats(),
+        "signatures": event_verifier.stats(),
+    }